@@ -1,4 +1,15 @@
-import sys
+import os, sys, time
+from contextlib import contextmanager
+
+
+# sections of the work timed separately (see timer), summed up in the counters time_<name>
+timer_names = ['hash', 'copy', 'exif', 'face', 'image_hash', 'geocode', 'db']
+
+# per process counters, collected by mt_ops after each handled chunk
+counter_names = ['bytes_read', 'bytes_written', 'bytes_copied', 'bytes_avoided',
+        'placed_copy', 'placed_move-rename', 'placed_reflink', 'placed_hardlink', 'partial_matched',
+        'cache_hits', 'skipped', 'resumed', 'quarantined'] + [ 'time_' + name for name in timer_names ]
+counters = dict.fromkeys(counter_names, 0)
 
 
 def print_bold(string):
@@ -9,6 +20,48 @@ def stdout(string):
     sys.stdout.write('{}[0K\r'.format(string))
 
 
+def count(name, value):
+    counters[name] += value
+
+
+class timer:
+    '''
+    Adds the time spent in the with block to the counter time_<name>.
+    '''
+    def __init__(self, name):
+        self.name = 'time_' + name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *args):
+        counters[self.name] += time.perf_counter() - self.start
+
+
+@contextmanager
+def atomic_write(path, mode='w'):
+    '''
+    Writes path through path.tmp, which replaces path once the with block completed, readers never see a partial file.
+    '''
+    with open(path + '.tmp', mode) as f:
+        yield f
+    os.replace(path + '.tmp', path)
+
+
+def format_counters(totals):
+    output = []
+    for name in counter_names:
+        if not totals[name]:
+            continue
+        if name.startswith('bytes_'):
+            output.append('{} {:.1f} MiB'.format(name.replace('_', ' '), totals[name]/1048576))
+        elif name.startswith('time_'):
+            output.append('{} {:.2f} s'.format(name.replace('_', ' '), totals[name]))
+        else:
+            output.append('{} {}'.format(name.replace('_', ' '), totals[name]))
+    return ' | '.join(output)
+
+
 def merge_dict(a, b):
     '''
     Merges two dicts.
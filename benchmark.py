@@ -0,0 +1,397 @@
+#!/usr/bin/env python3
+import argparse
+import os
+import sys
+import json
+import shlex
+import shutil
+import pickle
+import time
+import tempfile
+import subprocess
+import db_ops
+import exif_ops
+import file_ops
+
+description='''
+Micro benchmarks for single parts of pic_sort.
+
+    db - compares the per key redis access with the batched access of db_ops
+         (uses and flushes the given redis database)
+    exif - compares the full exifread parse with the header-only parse of the meta data tags
+    hash - content hashing throughput per algorithm and buffer size (0 maps the file into memory)
+    faces - face detection at full size vs. images decoded at a reduced scale
+    generate - generates a synthetic photo library (see synth_ops.generate_library)
+    scan - times a cold and a cached scan of a directory tree, checks that unreadable directories
+           and files or missing paths given as path are skipped, exits with 1 if a check failed
+    queue - checks the lease queue of --distributed on a local redis server (uses and flushes the given database):
+            leases, stolen leases and stale acks directly, then a run of the QueuePool with several local workers
+            on entries of which one kills its worker and one raises, exits with 1 if a check failed
+    pipeline - runs pic_sort on a synthetic library of the given size into a fresh destination
+               (and again unchanged with --rerun), records the wall time and peak memory of every stage
+               from its run_report.json and compares them with a stored baseline,
+               exits with 1 if a stage got slower or larger than --tolerance allows
+'''
+
+
+def timed(name, n, function, *args, unit='keys'):
+    start = time.perf_counter()
+    function(*args)
+    elapsed = time.perf_counter() - start
+    print('{:40} {:8.3f}s {:12.0f} {}/s'.format(name, elapsed, n/elapsed, unit))
+
+
+def benchmark_db(args):
+    db = db_ops.RedisStore(args.host, args.port, args.db)
+    db.flushdb()
+    items = [ ('{:0128x}'.format(i), {'date': '20190101_120000', 'original_name': 'IMG_{:04}.JPG'.format(i)}) for i in range(args.keys) ]
+
+    def set_per_key():
+        for k, v in items:
+            db.set(k, pickle.dumps(v))
+
+    def get_per_key():
+        for k, _ in items:
+            if db.exists(k):
+                pickle.loads(db.get(k))
+
+    def iter_per_key():
+        for k in db.scan_iter():
+            pickle.loads(db.get(k))
+
+    def set_batched():
+        for i in range(0, len(items), 1000):
+            db_ops.set_many(db, items[i:i+1000])
+
+    def get_batched():
+        db_ops.get_many(db, [ k for k, _ in items ])
+
+    def iter_batched():
+        for _ in db_ops.iter_db(db):
+            pass
+
+    timed('set per key', args.keys, set_per_key)
+    timed('get per key (exists + get)', args.keys, get_per_key)
+    timed('iterate per key (scan + get)', args.keys, iter_per_key)
+    db.flushdb()
+    timed('set_many (pipeline)', args.keys, set_batched)
+    timed('get_many (mget)', args.keys, get_batched)
+    timed('iter_db (scan + mget)', args.keys, iter_batched)
+    db.flushdb()
+
+
+def benchmark_exif(args):
+    from main_ops import meta_tags
+    from basic_ops import counters
+    tags = [ tag for group in meta_tags for tag in group ]
+    files = args.files * args.repeat
+
+    def read_exifread():
+        for filename in files:
+            exif_ops.serialize_exif_data(exif_ops.read_exif_data(filename), tags)
+
+    def read_header_only():
+        for filename in files:
+            exif_ops.read_meta_fields(filename, meta_tags)
+
+    for name, function in [('exifread (whole file)', read_exifread), ('read_meta_fields (header)', read_header_only)]:
+        counters['bytes_read'] = 0
+        timed(name, len(files), function, unit='files')
+        print('{:40} {:8.2f} KiB read per file'.format('', counters['bytes_read'] / len(files) / 1024))
+
+
+def benchmark_hash(args):
+    files = args.files
+    if not files:
+        tmp = tempfile.NamedTemporaryFile(prefix='benchmark_hash_')
+        for _ in range(args.size):
+            tmp.write(os.urandom(1048576))
+        tmp.flush()
+        files = [tmp.name]
+    size = sum( os.path.getsize(filename) for filename in files ) * args.repeat
+    for filename in files:  # warm up the page cache
+        file_ops.content_digest(filename)
+
+    def hash_files(algorithm, buffer_size):
+        for _ in range(args.repeat):
+            for filename in files:
+                file_ops.content_digest(filename, algorithm, buffer_size)
+
+    for algorithm in args.algorithms:
+        for buffer_size in args.buffer_sizes:
+            timed('{} {}'.format(algorithm, 'mmap' if buffer_size == 0 else '{} KiB'.format(buffer_size // 1024)),
+                    size / 1048576, hash_files, algorithm, buffer_size, unit='MiB')
+
+
+def benchmark_faces(args):
+    import face_ops
+    files = args.files * args.repeat
+    for max_size in args.sizes:
+        params = face_ops.detector_params(max_size)
+        found = []
+        timed('detect faces at {}'.format(max_size or 'full size'), len(files),
+                lambda: found.extend( len(face_ops.detect_faces(filename, params)) for filename in files ), unit='files')
+        print('{:40} {:8} faces found'.format('', sum(found)))
+
+
+def parse_count(value):
+    # 1000, 100k or 1M
+    multiplier = {'k': 1000, 'm': 1000000}.get(value[-1:].lower(), 1)
+    return int(float(value[:-1] if multiplier > 1 else value) * multiplier)
+
+
+def benchmark_generate(args):
+    import synth_ops
+    start = time.perf_counter()
+    params = synth_ops.generate_library(args.directory, args.files, args.seed, raw_size=args.raw_size)
+    print('{} files in {} ({:.1f}s)'.format(params['files'], args.directory, time.perf_counter() - start))
+
+
+def run_pic_sort(library, dest_dir, args, log):
+    command = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'pic_sort.py'),
+            '--store', args.store, '-t', str(args.threads)] + ([] if args.faces else ['--no-faces']) + shlex.split(args.pic_sort_args) + \
+            ['-p', library, '--', dest_dir]
+    log.write('$ {}\n'.format(' '.join(command)))
+    log.flush()
+    subprocess.run(command, stdout=log, stderr=subprocess.STDOUT, check=True)
+    with open(os.path.join(dest_dir, 'run_report.json')) as f:
+        report = json.load(f)
+    stages = {}
+    for metrics in report['stages']:
+        stages[metrics['stage']] = {'wall_time': metrics['wall_time'], 'max_rss': metrics['max_rss'], 'items': metrics.get('items')}
+    return {'wall_time': report['wall_time'], 'max_rss': max( metrics['max_rss'] for metrics in report['stages'] ), 'stages': stages}
+
+
+def compare_results(baseline, results, tolerance, min_time):
+    '''
+    Compares the wall time and peak memory of every run and stage of results with the baseline,
+    stages faster than min_time seconds only regress by more than min_time.
+    :return: number of regressions
+    '''
+    regressions = 0
+    for run, measured in results['runs'].items():
+        if run not in baseline['runs']:
+            continue
+        base_run = baseline['runs'][run]
+        rows = [ ('total', base_run, measured) ] + [ (stage, base_run['stages'][stage], metrics)
+                for stage, metrics in measured['stages'].items() if stage in base_run['stages'] ]
+        for stage, base, new in rows:
+            slower = new['wall_time'] > base['wall_time'] * (1 + tolerance) and new['wall_time'] - base['wall_time'] > min_time
+            larger = new['max_rss'] > base['max_rss'] * (1 + tolerance)
+            print('{:6} {:24} {:8.3f}s {:8.3f}s {:+7.1%} {:8.1f} MiB {:8.1f} MiB {:+7.1%} {}'.format(run, stage,
+                base['wall_time'], new['wall_time'], new['wall_time'] / max(base['wall_time'], 1e-9) - 1,
+                base['max_rss'] / 1024, new['max_rss'] / 1024, new['max_rss'] / max(base['max_rss'], 1) - 1,
+                'REGRESSION' if slower or larger else ''))
+            regressions += slower or larger
+    return regressions
+
+
+def check(failed, name, passed):
+    print('{:60} {}'.format(name, 'ok' if passed else 'FAILED'))
+    if not passed:
+        failed.append(name)
+
+
+def benchmark_scan(args):
+    from scan_ops import Scanner
+    extensions = ['.jpg', '.jpeg', '.cr2', '.gpx']
+    with tempfile.TemporaryDirectory() as work_dir:
+        cache_path = os.path.join(work_dir, 'scan_cache.pickle')
+        for run in ['cold', 'cached']:
+            scanner = Scanner([args.directory], extensions, cache_path, num_threads=args.threads)
+            timed('scan {} ({} threads)'.format(run, args.threads), 1, lambda: sum( 1 for _ in scanner.scan() ), unit='scans')
+            scanner.save_cache()
+            print('    {} files, {} directories listed, {} reused'.format(scanner.total, scanner.listed, scanner.reused))
+
+        failed = []
+        tree = os.path.join(work_dir, 'tree')
+        for directory in ['sub', 'locked']:
+            os.makedirs(os.path.join(tree, directory))
+        for name in ['a.jpg', 'sub/b.jpg', 'locked/c.jpg']:
+            open(os.path.join(tree, name), 'w').close()
+        os.chmod(os.path.join(tree, 'locked'), 0)
+        try:
+            locked = os.access(os.path.join(tree, 'locked'), os.R_OK)  # root reads it anyway
+            scanner = Scanner([tree, os.path.join(tree, 'a.jpg'), os.path.join(tree, 'missing')], extensions)
+            found = sorted( os.path.relpath(path, tree) for path, _ in scanner.scan() )
+        finally:
+            os.chmod(os.path.join(tree, 'locked'), 0o755)
+        check(failed, 'a file or missing path given as path is skipped', found.count('a.jpg') == 1)
+        check(failed, 'an unreadable directory is skipped' if not locked else 'the locked directory is readable (root), listed',
+            found == sorted(['a.jpg', 'sub/b.jpg'] + (['locked/c.jpg'] if locked else [])))
+    if failed:
+        sys.exit('{} checks failed'.format(len(failed)))
+
+
+def queue_handler(entry, delay):
+    if entry[0] == 'kill':
+        os._exit(3)
+    if entry[0] == 'raise':
+        raise ValueError('raised by the entry')
+    time.sleep(delay)
+    return '', entry[0], 1
+
+
+def benchmark_queue(args):
+    import multiprocessing
+    import queue_ops
+    failed = []
+
+    lease_queue = queue_ops.LeaseQueue(db_ops.RedisStore(args.host, args.port, args.db, 'work_queue:'))
+    results = db_ops.RedisStore(args.host, args.port, args.db, 'results:')
+    quarantine = db_ops.RedisStore(args.host, args.port, args.db, 'quarantine:')
+    db_ops.RedisStore(args.host, args.port, args.db).flushdb()
+
+    lease_queue.push('a:0', 'task')
+    leased = lease_queue.lease(1)
+    check(failed, 'lease returns the pushed task', leased == ('a:0', 'task', 1))
+    check(failed, 'a leased task is invisible to other workers', lease_queue.lease(1) is None)
+    time.sleep(1.2)
+    check(failed, 'an expired lease is stolen', lease_queue.lease(1) == ('a:0', 'task', 2))
+    check(failed, 'the ack of the stolen lease is dropped', not lease_queue.ack('a:0', 1, 'stale'))
+    check(failed, 'the ack of the current lease is queued', lease_queue.ack('a:0', 2, 'result') and lease_queue.result(1) == 'result')
+    lease_queue.push('a:1', 'task')
+    lease_queue.lease(60)
+    lease_queue.clear()
+    lease_queue.push('b:1', 'task')
+    check(failed, 'the ack of a task of an earlier run is dropped', not lease_queue.ack('a:1', 1, 'stale') and not lease_queue.results_waiting())
+    check(failed, 'the task of the current run is still pending', lease_queue.counts() == (1, 0))
+
+    def entries():
+        for i in range(args.entries):
+            yield ('{:06}'.format(i),)
+            if i == args.entries // 2:
+                yield ('kill',)
+                yield ('raise',)
+
+    pool = queue_ops.QueuePool(lease_queue, chunk_size=args.chunk_size, quarantine=quarantine)
+    workers = multiprocessing.Process(target=queue_ops.run_workers, args=(lease_queue, args.workers, args.lease_timeout, args.lease_timeout + 2))
+    workers.start()
+    start = time.perf_counter()
+    totals = pool.run(entries, queue_handler, db=results, handler_args=(args.delay,))
+    elapsed = time.perf_counter() - start
+    workers.join()
+    quarantined = { key: value for chunk in quarantine.iter_chunks(100) for key, value in chunk }
+    check(failed, 'all other entries were handled', results.dbsize() == args.entries)
+    check(failed, 'the raising and the killing entry were quarantined', sorted(quarantined) == ['queue_handler:kill', 'queue_handler:raise'])
+    check(failed, 'the killing entry was quarantined after {} deaths'.format(queue_ops.entry_attempts),
+        pickle.loads(quarantined.get('queue_handler:kill', pickle.dumps({})))['attempts'] == queue_ops.entry_attempts)
+    check(failed, 'the queue is empty', lease_queue.counts() == (0, 0) and not lease_queue.results_waiting())
+    print('{} entries by {} workers in {:.3f}s, {} quarantined'.format(args.entries, args.workers, elapsed, totals['quarantined']))
+    db_ops.RedisStore(args.host, args.port, args.db).flushdb()
+    if failed:
+        sys.exit('{} checks failed'.format(len(failed)))
+
+
+def benchmark_pipeline(args):
+    import synth_ops
+    library = os.path.join(args.work_dir, 'library_{}_{}'.format(args.files, args.seed))
+    dest_dir = os.path.join(args.work_dir, 'destination')
+    print('generate library of {} files at {}'.format(args.files, library))
+    synth_ops.generate_library(library, args.files, args.seed, raw_size=args.raw_size)
+
+    if os.path.exists(dest_dir):
+        shutil.rmtree(dest_dir)
+    os.makedirs(dest_dir)
+    if args.store.startswith('redis://'):  # start cold like the fresh sqlite database
+        db = db_ops.init_db(args.store, dest_dir)
+        for namespace in db_ops.namespaces:
+            getattr(db, namespace).flushdb()
+
+    results = {'library': synth_ops.library_params(args.files, args.seed, (320, 240), args.raw_size, synth_ops.default_fractions),
+            'store': args.store.split(':')[0], 'threads': args.threads, 'faces': args.faces, 'pic_sort_args': args.pic_sort_args, 'runs': {}}
+    log_path = os.path.join(args.work_dir, 'pic_sort.log')
+    with open(log_path, 'w') as log:
+        for run in ['cold', 'rerun'] if args.rerun else ['cold']:
+            print('{} run, output in {}'.format(run, log_path))
+            results['runs'][run] = run_pic_sort(library, dest_dir, args, log)
+
+    for run, measured in results['runs'].items():
+        for stage, metrics in [ ('total', measured) ] + list(measured['stages'].items()):
+            print('{:6} {:24} {:8.3f}s {:8.1f} MiB'.format(run, stage, metrics['wall_time'], metrics['max_rss'] / 1024))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=1)
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=1)
+        print('baseline written to {}'.format(args.baseline))
+    elif os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline['library'] != results['library'] or baseline['pic_sort_args'] != results['pic_sort_args']:
+            sys.exit('the baseline {} was measured on another library or with other options'.format(args.baseline))
+        print('\ncompared with the baseline {}'.format(args.baseline))
+        regressions = compare_results(baseline, results, args.tolerance, args.min_time)
+        if regressions:
+            sys.exit('{} regressions'.format(regressions))
+
+
+parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter, description=description)
+subparsers = parser.add_subparsers(dest='benchmark', required=True)
+parser_db = subparsers.add_parser('db', help='redis access per key vs. batched')
+parser_db.add_argument('-n', '--keys', type=int, help='number of keys to write and read', default=100000)
+parser_db.add_argument('--host', help='redis host', default='localhost')
+parser_db.add_argument('--port', type=int, help='redis port', default=6379)
+parser_db.add_argument('--db', type=int, help='redis database to use, it is flushed', default=15)
+parser_db.set_defaults(function=benchmark_db)
+parser_exif = subparsers.add_parser('exif', help='exifread vs. header-only exif parsing')
+parser_exif.add_argument('files', nargs='+', help='jpeg/tiff/cr2 sample files')
+parser_exif.add_argument('-r', '--repeat', type=int, help='number of passes over the files', default=10)
+parser_exif.set_defaults(function=benchmark_exif)
+parser_hash = subparsers.add_parser('hash', help='content hashing throughput')
+parser_hash.add_argument('files', nargs='*', help='files to hash (default: a temporary file of --size MiB)')
+parser_hash.add_argument('--size', type=int, help='size of the temporary file in MiB', default=256)
+parser_hash.add_argument('-r', '--repeat', type=int, help='number of passes over the files', default=3)
+parser_hash.add_argument('-a', '--algorithms', nargs='+', choices=file_ops.hash_algorithms, default=file_ops.hash_algorithms)
+parser_hash.add_argument('-b', '--buffer-sizes', dest='buffer_sizes', type=int, nargs='+', help='read buffer sizes in bytes, 0 for mmap',
+        default=[32768, 1048576, 16777216, 0])
+parser_hash.set_defaults(function=benchmark_hash)
+parser_faces = subparsers.add_parser('faces', help='face detection at full and reduced decoding sizes')
+parser_faces.add_argument('files', nargs='+', help='jpeg/cr2 sample files')
+parser_faces.add_argument('-r', '--repeat', type=int, help='number of passes over the files', default=1)
+parser_faces.add_argument('-s', '--sizes', type=int, nargs='+', help='longer sides to decode at, 0 for full size', default=[0, 2400, 1600, 1000])
+parser_faces.set_defaults(function=benchmark_faces)
+parser_generate = subparsers.add_parser('generate', help='generate a synthetic photo library')
+parser_generate.add_argument('directory', help='directory of the library, generated again if it was generated with other parameters')
+parser_generate.add_argument('-n', '--files', type=parse_count, help='number of pictures, e.g. 1000, 100k or 1M', default=1000)
+parser_generate.add_argument('--seed', type=int, help='seed of the generated library', default=0)
+parser_generate.add_argument('--raw-size', dest='raw_size', type=int, help='size of the CR2 like raw files in MiB', default=8)
+parser_generate.set_defaults(function=benchmark_generate)
+parser_scan = subparsers.add_parser('scan', help='cold and cached scan of a directory tree')
+parser_scan.add_argument('directory', help='directory tree to scan, e.g. a generated library')
+parser_scan.add_argument('-t', '--threads', type=int, help='number of listing threads', default=8)
+parser_scan.set_defaults(function=benchmark_scan)
+parser_queue = subparsers.add_parser('queue', help='lease queue of --distributed with several local workers')
+parser_queue.add_argument('-n', '--entries', type=int, help='number of entries to handle', default=1000)
+parser_queue.add_argument('-t', '--workers', type=int, help='number of local workers', default=4)
+parser_queue.add_argument('--chunk-size', dest='chunk_size', type=int, help='entries per task', default=20)
+parser_queue.add_argument('--delay', type=float, help='seconds each entry takes', default=0.001)
+parser_queue.add_argument('--lease-timeout', dest='lease_timeout', type=int, help='seconds until the task of a dead worker is stolen', default=1)
+parser_queue.add_argument('--host', help='redis host', default='localhost')
+parser_queue.add_argument('--port', type=int, help='redis port', default=6379)
+parser_queue.add_argument('--db', type=int, help='redis database to use, it is flushed', default=15)
+parser_queue.set_defaults(function=benchmark_queue)
+parser_pipeline = subparsers.add_parser('pipeline', help='all stages of pic_sort on a synthetic library, compared with a baseline')
+parser_pipeline.add_argument('-n', '--files', type=parse_count, help='number of pictures, e.g. 1000, 100k or 1M', default=1000)
+parser_pipeline.add_argument('--seed', type=int, help='seed of the generated library', default=0)
+parser_pipeline.add_argument('--raw-size', dest='raw_size', type=int, help='size of the CR2 like raw files in MiB', default=8)
+parser_pipeline.add_argument('--store', help='store passed to pic_sort, a redis store is flushed before the first run', default='sqlite://')
+parser_pipeline.add_argument('-t', '--threads', type=int, help='number of workers of pic_sort', default=4)
+parser_pipeline.add_argument('--faces', help='include face detection (requires face_recognition)', action='store_true')
+parser_pipeline.add_argument('--rerun', help='also measure a second run on the unchanged library', action='store_true')
+parser_pipeline.add_argument('-a', '--pic-sort-args', dest='pic_sort_args', help='further options of pic_sort, e.g. "--ingest --partial-match"', default='')
+parser_pipeline.add_argument('-w', '--work-dir', dest='work_dir', help='directory of the generated libraries and the destination',
+        default=os.path.join(tempfile.gettempdir(), 'pic_sort_benchmark'))
+parser_pipeline.add_argument('-b', '--baseline', help='baseline to compare with', default='benchmark_baseline.json')
+parser_pipeline.add_argument('--save-baseline', dest='save_baseline', help='store the results as the new baseline instead of comparing', action='store_true')
+parser_pipeline.add_argument('-o', '--output', help='also write the results to this json file')
+parser_pipeline.add_argument('--tolerance', type=float, help='relative increase of time or memory reported as regression', default=0.25)
+parser_pipeline.add_argument('--min-time', dest='min_time', type=float, help='increase in seconds below which a slower stage is not reported', default=0.1)
+parser_pipeline.set_defaults(function=benchmark_pipeline)
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    args.function(args)
@@ -0,0 +1,171 @@
+import os
+import json
+from file_ops import link_file
+from basic_ops import atomic_write
+
+default_fan_out = [2, 2]
+
+
+class ContentStore:
+    '''
+    Layout of the content addressed files of a destination:
+        hashed/raw/<fan-out>/<content id>                        - the stored files
+        hashed/with_extension/<fan-out>/<content id><extension>  - symlinks to the stored files
+    The fan-out is a list of prefix lengths of the content id, [2, 2] stores ab12... at ab/12/ab12...,
+    [] is the flat layout of older versions. The content ids are hex digests of the algorithm (see file_ops.hash_algorithms).
+    Both are recorded in hashed/store.json.
+    Picklable, every path of a stored file is resolved through here.
+    '''
+    def __init__(self, dest_dir, fan_out, algorithm='sha512'):
+        self.dest_dir = dest_dir
+        self.fan_out = list(fan_out)
+        self.algorithm = algorithm
+        self.raw_dir = os.path.join(dest_dir, 'hashed/raw')
+        self.created_dirs = set()
+
+    def __getstate__(self):
+        return {'dest_dir': self.dest_dir, 'fan_out': self.fan_out, 'algorithm': self.algorithm, 'raw_dir': self.raw_dir}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.created_dirs = set()
+
+    def shard(self, content_id):
+        parts = []
+        position = 0
+        for length in self.fan_out:
+            parts.append(content_id[position:position+length])
+            position += length
+        return '/'.join(parts + [content_id])
+
+    def raw_path(self, content_id):
+        # relative to the destination
+        return 'hashed/raw/' + self.shard(content_id)
+
+    def extension_path(self, content_id, extension):
+        return 'hashed/with_extension/' + self.shard(content_id) + extension
+
+    def path(self, content_id, create=False):
+        return self.absolute(self.raw_path(content_id), create)
+
+    def path_with_extension(self, content_id, extension, create=False):
+        return self.absolute(self.extension_path(content_id, extension), create)
+
+    def absolute(self, relative_path, create=False):
+        path = os.path.join(self.dest_dir, relative_path)
+        directory = os.path.dirname(path)
+        if create and directory not in self.created_dirs:
+            os.makedirs(directory, exist_ok=True)
+            self.created_dirs.add(directory)
+        return path
+
+    def exists(self, content_id):
+        return os.path.exists(self.path(content_id))
+
+    def manifest_key(self, signature):
+        # the source manifest may be shared by destinations with different algorithms
+        if self.algorithm == 'sha512':
+            return signature
+        return self.algorithm + ':' + signature
+
+
+def store_config_path(dest_dir):
+    return os.path.join(dest_dir, 'hashed/store.json')
+
+
+def read_store_config(dest_dir):
+    path = store_config_path(dest_dir)
+    if os.path.exists(path):
+        with open(path) as f:
+            config = json.load(f)
+        config.setdefault('algorithm', 'sha512')
+        return config
+    # destinations of older versions store all files flat
+    raw_dir = os.path.join(dest_dir, 'hashed/raw')
+    if os.path.isdir(raw_dir) and any( not name.startswith('.') for name in os.listdir(raw_dir) ):
+        return {'fan_out': [], 'algorithm': 'sha512'}
+    return {'fan_out': default_fan_out, 'new': True}
+
+
+def write_store_config(dest_dir, config):
+    path = store_config_path(dest_dir)
+    with atomic_write(path) as f:
+        json.dump(config, f)
+
+
+def open_store(dest_dir, fan_out=None, migrate=False, algorithm=None):
+    '''
+    Opens the content store of dest_dir, a different fan_out than the recorded one requires migrate.
+    An interrupted migration is finished first.
+    The algorithm is chosen once by the first run, the content ids of a destination never mix algorithms.
+    '''
+    config = read_store_config(dest_dir)
+    if config.get('new'):
+        config = {'fan_out': list(fan_out) if fan_out is not None else default_fan_out, 'algorithm': algorithm or 'sha512'}
+        write_store_config(dest_dir, config)
+    elif algorithm is not None and algorithm != config['algorithm']:
+        raise ValueError('the content store at {} uses the hash algorithm {}, sort into a new destination to use {}'.format(
+            dest_dir, config['algorithm'], algorithm))
+    if config.get('migrating'):
+        migrate_store(dest_dir, config['fan_out'])
+        config = read_store_config(dest_dir)
+    if fan_out is not None and list(fan_out) != config['fan_out']:
+        if not migrate:
+            raise ValueError('the content store at {} uses the fan-out {}, use --migrate-store to convert it to {}'.format(
+                dest_dir, config['fan_out'], list(fan_out)))
+        migrate_store(dest_dir, fan_out)
+        config = read_store_config(dest_dir)
+    write_store_config(dest_dir, config)
+    return ContentStore(dest_dir, config['fan_out'], config['algorithm'])
+
+
+def migrate_store(dest_dir, fan_out):
+    '''
+    Moves all stored files to the given fan-out in place by rename and recreates the extension links.
+    The files are found wherever they are, so an interrupted migration is simply run again.
+    :return: number of moved files
+    '''
+    config = read_store_config(dest_dir)
+    config.update({'fan_out': list(fan_out), 'migrating': True})
+    write_store_config(dest_dir, config)
+    store = ContentStore(dest_dir, fan_out)
+
+    moved = 0
+    for root, name in walk_files(store.raw_dir):
+        path = os.path.join(root, name)
+        if path != store.path(name):
+            os.rename(path, store.path(name, create=True))
+            moved += 1
+
+    extension_dir = os.path.join(dest_dir, 'hashed/with_extension')
+    for root, name in walk_files(extension_dir):
+        content_id, extension = os.path.splitext(name)
+        path = os.path.join(root, name)
+        target = store.path_with_extension(content_id, extension, create=True)
+        if path != target:
+            os.remove(path)
+            link_file(store.path(content_id), target)
+
+    for directory in [ store.raw_dir, extension_dir ]:
+        remove_empty_dirs(directory)
+
+    config.pop('migrating')
+    write_store_config(dest_dir, config)
+    return moved
+
+
+def walk_files(directory):
+    # yields (directory, name) of all files below directory, temporary files (.ingest_*, .placing_*) are skipped
+    for root, _, files in os.walk(directory):
+        for name in files:
+            if not name.startswith('.'):
+                yield root, name
+
+
+def remove_empty_dirs(directory):
+    for root, _, _ in os.walk(directory, topdown=False):
+        if root != directory:
+            try:
+                os.rmdir(root)
+            except OSError:  # not empty
+                pass
@@ -1,30 +1,359 @@
+import os
 import pickle
-from redis import Redis
+import sqlite3
+from datetime import datetime
+from urllib.parse import urlparse
+from meta_ops import MetaRecord, is_record
+from basic_ops import timer
 from multiprocessing.managers import Namespace
+try:
+    from redis import Redis, ConnectionPool
+except ImportError:  # only required by the redis store
+    Redis = None
 
-def init_db(restore_file, host='localhost', port=6379, db_offset=0):
+namespaces = ['source_hash', 'hash_meta', 'hash_datename', 'hash_face', 'source_manifest', 'location_cache', 'hash_exif', 'size_index', 'hash_phash', 'journal', 'quarantine', 'work_queue']
+# in redis the namespaces of the first versions keep a database each,
+# all later ones share the next database and are told apart by their name as key prefix
+own_database_namespaces = 4
+
+# one connection (pool) per process and database, never inherited by forked workers
+connections = {}
+tables = {}
+
+
+class RedisStore:
+    '''
+    Picklable handle of one redis database (or of the keys starting with prefix in it), passed to the workers instead of a Redis client.
+    Each process connects through its own connection pool, all Redis methods are available on the handle of a database,
+    a prefixed handle only provides the subset of the SqliteStore.
+    '''
+    def __init__(self, host, port, db, prefix=''):
+        self.host = host
+        self.port = port
+        self.db = db
+        self.prefix = prefix
+
+    def connect(self):
+        key = (os.getpid(), self.host, self.port, self.db)
+        if key not in connections:
+            connections[key] = ConnectionPool(host=self.host, port=self.port, db=self.db)
+        return Redis(connection_pool=connections[key])
+
+    def __getattr__(self, name):
+        if name.startswith('__') or name in ('host', 'port', 'db', 'prefix') or self.prefix:
+            raise AttributeError(name)
+        return getattr(self.connect(), name)
+
+    def key(self, key):
+        return '{}{}'.format(self.prefix, key) if self.prefix else key
+
+    def get(self, key):
+        return self.connect().get(self.key(key))
+
+    def mget(self, keys):
+        return self.connect().mget([ self.key(k) for k in keys ])
+
+    def set(self, key, value):
+        return self.connect().set(self.key(key), value)
+
+    def setnx(self, key, value):
+        return self.connect().setnx(self.key(key), value)
+
+    def write_many(self, items):
+        pipeline = self.connect().pipeline(transaction=False)
+        for k, v in items:
+            if v is not None:
+                pipeline.set(self.key(k), v)
+            else:
+                pipeline.append(self.key(k), b'')
+        pipeline.execute()
+
+    def incrby(self, key, amount):
+        return self.connect().incrby(self.key(key), amount)
+
+    def iter_chunks(self, chunk_size):
+        redis = self.connect()
+        cursor = None
+        while cursor != 0:
+            cursor, keys = redis.scan(cursor or 0, match=self.prefix + '*' if self.prefix else None, count=chunk_size)
+            if keys:
+                yield [ (k.decode('UTF-8')[len(self.prefix):], v) for k, v in zip(keys, redis.mget(keys)) ]
+
+    def iter_keys(self, chunk_size=1000):
+        redis = self.connect()
+        cursor = None
+        while cursor != 0:
+            cursor, keys = redis.scan(cursor or 0, match=self.prefix + '*', count=chunk_size)
+            if keys:
+                yield keys
+
+    def dbsize(self):
+        if not self.prefix:
+            return self.connect().dbsize()
+        return sum( len(keys) for keys in self.iter_keys() )
+
+    def flushdb(self):
+        if not self.prefix:
+            return self.connect().flushdb()
+        redis = self.connect()
+        for keys in self.iter_keys():
+            redis.delete(*keys)
+
+
+class SqliteStore:
+    '''
+    Picklable handle of one table of an embedded sqlite database (write ahead log, batched transactions),
+    provides the subset of the Redis methods used by pic_sort.
+    '''
+    def __init__(self, path, table):
+        self.path = path
+        self.table = table
+
+    def connect(self):
+        key = (os.getpid(), self.path)
+        if key not in connections:
+            connection = sqlite3.connect(self.path, timeout=600, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            connections[key] = connection
+        connection = connections[key]
+        if key + (self.table,) not in tables:
+            connection.execute('CREATE TABLE IF NOT EXISTS {} (key TEXT PRIMARY KEY, value BLOB) WITHOUT ROWID'.format(self.table))
+            tables[key + (self.table,)] = True
+        return connection
+
+    def get(self, key):
+        row = self.connect().execute('SELECT value FROM {} WHERE key = ?'.format(self.table), (key,)).fetchone()
+        return row[0] if row else None
+
+    def mget(self, keys):
+        connection = self.connect()
+        keys = [ k.decode('UTF-8') if isinstance(k, bytes) else k for k in keys ]
+        values = {}
+        for i in range(0, len(keys), 500):
+            chunk = keys[i:i+500]
+            query = 'SELECT key, value FROM {} WHERE key IN ({})'.format(self.table, ','.join('?'*len(chunk)))
+            values.update(connection.execute(query, chunk).fetchall())
+        return [ values.get(k) for k in keys ]
+
+    def set(self, key, value):
+        self.connect().execute('INSERT OR REPLACE INTO {} VALUES (?, ?)'.format(self.table), (key, value))
+
+    def write_many(self, items):
+        items = list(items)
+        connection = self.connect()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            connection.executemany('INSERT OR REPLACE INTO {} VALUES (?, ?)'.format(self.table), [ (k, v) for k, v in items if v is not None ])
+            connection.executemany('INSERT OR IGNORE INTO {} VALUES (?, ?)'.format(self.table), [ (k, b'') for k, v in items if v is None ])
+            connection.execute('COMMIT')
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+
+    def iter_chunks(self, chunk_size):
+        connection = self.connect()
+        last_key = ''
+        while True:
+            rows = connection.execute('SELECT key, value FROM {} WHERE key > ? ORDER BY key LIMIT ?'.format(self.table), (last_key, chunk_size)).fetchall()
+            if not rows:
+                return
+            yield rows
+            last_key = rows[-1][0]
+
+    def incrby(self, key, amount):
+        query = 'INSERT INTO {} VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET value = value + excluded.value RETURNING value'.format(self.table)
+        return self.connect().execute(query, (key, amount)).fetchone()[0]
+
+    def setnx(self, key, value):
+        return self.connect().execute('INSERT OR IGNORE INTO {} VALUES (?, ?)'.format(self.table), (key, value)).rowcount == 1
+
+    def dbsize(self):
+        return self.connect().execute('SELECT COUNT(*) FROM {}'.format(self.table)).fetchone()[0]
+
+    def flushdb(self):
+        self.connect().execute('DELETE FROM {}'.format(self.table))
+
+
+def open_db(store_url, dest_dir=None, db_offset=0):
+    '''
+    Opens all namespaces of the store given by store_url:
+        redis://<host>:<port>/<first database>  - 5 redis databases, see own_database_namespaces
+        sqlite:///<path>                        - one table per namespace, sqlite:// uses database.sqlite at dest_dir
+    '''
+    url = urlparse(store_url)
     db = Namespace()
-    db.source_hash = Redis(host=host, port=port, db=db_offset+0)
-    db.source_hash.flushdb()
-    db.hash_meta = Redis(host=host, port=port, db=db_offset+1)
-    db.hash_datename = Redis(host=host, port=port, db=db_offset+2)
-    db.hash_face = Redis(host=host, port=port, db=db_offset+3)
+    for i, namespace in enumerate(namespaces):
+        if url.scheme == 'redis':
+            offset = int(url.path.strip('/') or db_offset)
+            if i < own_database_namespaces:
+                setattr(db, namespace, RedisStore(url.hostname or 'localhost', url.port or 6379, offset+i))
+            else:
+                setattr(db, namespace, RedisStore(url.hostname or 'localhost', url.port or 6379, offset+own_database_namespaces, namespace + ':'))
+        elif url.scheme == 'sqlite':
+            path = url.netloc + url.path or os.path.join(dest_dir, 'database.sqlite')
+            setattr(db, namespace, SqliteStore(path, namespace))
+        else:
+            raise ValueError('Unknown store {}'.format(store_url))
+    return db
+
+
+def init_db(store_url, dest_dir, db_offset=0, full_rescan=False, resume=True):
+    '''
+    Opens all namespaces of the store (see open_db) for a run.
+    If the last run did not finish (see finish_run) it is resumed: the files it found (source_hash),
+    the entries each stage completed (journal) and the failed entries (quarantine) are kept, db.resumed is set.
+    '''
+    db = open_db(store_url, dest_dir, db_offset)
+    run = get(db.journal, 'run')
+    db.resumed = resume and not full_rescan and run is not None and run['state'] == 'running'
+    if not db.resumed:
+        db.source_hash.flushdb()
+        db.journal.flushdb()
+        db.quarantine.flushdb()
+    if full_rescan:
+        db.source_manifest.flushdb()
+    set(db.journal, 'run', {'state': 'running', 'started': datetime.now().isoformat(timespec='seconds'),
+        'resumed': run['started'] if db.resumed else None})
     return db
 
+
+def finish_run(db):
+    run = get(db.journal, 'run')
+    run['state'] = 'finished'
+    set(db.journal, 'run', run)
+
+
+def encode(value):
+    if isinstance(value, MetaRecord):
+        return value.pack()
+    return pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def decode(value):
+    if value is None:
+        return None
+    if is_record(value):
+        return MetaRecord.unpack(value)
+    try:
+        return pickle.loads(value)
+    except EOFError:
+        return None
+
+
 def get(db, key):
-    v = None
-    if db.exists(key):
-        try:
-            v = pickle.loads(db.get(key))
-        except EOFError:
-            pass
-    return v
+    with timer('db'):
+        value = db.get(key)
+    return decode(value)
+
+
+def get_many(db, keys, chunk_size=1000):
+    keys = list(keys)
+    values = []
+    for i in range(0, len(keys), chunk_size):
+        with timer('db'):
+            chunk = db.mget(keys[i:i+chunk_size])
+        values += [ decode(value) for value in chunk ]
+    return values
+
+
+def exists_many(db, keys, chunk_size=1000):
+    '''
+    :return: for every key whether it exists, also for keys created without a value
+    '''
+    keys = list(keys)
+    exists = []
+    for i in range(0, len(keys), chunk_size):
+        with timer('db'):
+            exists += [ value is not None for value in db.mget(keys[i:i+chunk_size]) ]
+    return exists
+
+
+def set(db, key, value):
+    value = encode(value)
+    with timer('db'):
+        db.set(key, value)
+
+
+def set_many(db, items):
+    '''
+    Writes all (key, value) pairs in one pipeline/transaction, a value of None only creates the key.
+    '''
+    items = [ (k, encode(v) if v is not None else None) for k, v in items ]
+    with timer('db'):
+        db.write_many(items)
+
+
+def reserve(db, key, amount=1):
+    '''
+    Atomically reserves amount consecutive numbers of the counter stored at key.
+    :return: the first reserved number, counters start at 0
+    '''
+    with timer('db'):
+        return db.incrby(key, amount) - amount
+
+
+def seed_counter(db, key, value):
+    '''
+    Creates the counter stored at key (see reserve) with value unless it exists.
+    '''
+    with timer('db'):
+        db.setnx(key, value)
+
+
+# writes queued by the handlers of the current chunk (see defer)
+deferred = []
+
+
+def merge_dict(stored, value):
+    # None does not replace a stored value
+    merged = dict(stored or {})
+    merged.update( (k, v) for k, v in value.items() if v is not None or k not in merged )
+    return merged
+
+
+def defer(db, key, value, merge=False):
+    '''
+    Queues a write of a handler, the writes of a chunk are passed with its result to the main process
+    and applied there in one batch (see apply_deferred). The main process is the only writer,
+    so with merge the dict value is merged into the stored dict (see merge_dict) without losing concurrent updates.
+    '''
+    for target, target_merge, items in deferred:
+        if target is db and target_merge == merge:
+            break
+    else:
+        items = {}
+        deferred.append((db, merge, items))
+    items[key] = merge_dict(items.get(key), value) if merge else value
+
+
+def take_deferred():
+    writes = list(deferred)
+    deferred.clear()
+    return writes
+
+
+def apply_deferred(writes):
+    for db, merge, items in writes:
+        if merge:
+            keys = list(items)
+            items = { key: merge_dict(stored, items[key]) for key, stored in zip(keys, get_many(db, keys)) }
+        set_many(db, list(items.items()))
+
+
+def iter_db_chunks(db, chunk_size=1000):
+    '''
+    Yields pages of (key, value) pairs, fetched with one request per page.
+    '''
+    chunks = db.iter_chunks(chunk_size)
+    while True:
+        with timer('db'):
+            chunk = next(chunks, None)
+        if chunk is None:
+            return
+        yield [ (k, decode(v)) for k, v in chunk ]
 
 
 def iter_db(db):
-    for k in db.scan_iter():
-        try:
-            v = pickle.loads(db.get(k))
-        except EOFError:
-            v = None
-        yield(k.decode('UTF-8'), v)
+    for chunk in iter_db_chunks(db):
+        yield from chunk
@@ -1,13 +1,212 @@
+import struct
 import exifread
 import location_ops
+from exifread.tags import EXIF_TAGS
+from basic_ops import count
+from file_ops import CountingFile
+
+header_size = 131072
+
+# tag ids of the exif tags readable by the fast path: ifd name -> {tag name: tag id}
+tag_ids = {
+        'Image': { entry[0]: tag for tag, entry in EXIF_TAGS.items() },
+        'Thumbnail': { entry[0]: tag for tag, entry in EXIF_TAGS.items() },
+        'EXIF': { entry[0]: tag for tag, entry in EXIF_TAGS.items() },
+        'GPS': { entry[0]: tag for tag, entry in EXIF_TAGS[0x8825][1][1].items() },
+        }
+EXIF_OFFSET = 0x8769
+GPS_OFFSET = 0x8825
+
+# struct formats and sizes of the tiff field types
+field_types = {1: ('B', 1), 2: ('s', 1), 3: ('H', 2), 4: ('L', 4), 5: ('L', 8), 6: ('b', 1), 7: ('B', 1),
+        8: ('h', 2), 9: ('l', 4), 10: ('l', 8), 11: ('f', 4), 12: ('d', 8)}
+
+
+class Truncated(Exception):
+    pass
 
 
 def read_exif_data(source):
     with open(source, 'rb') as f:
-        exif_data = exifread.process_file(f)
+        exif_data = exifread.process_file(CountingFile(f))
     return exif_data
 
 
+def find_tiff_header(data):
+    '''
+    :return: offset of the tiff header in a tiff/cr2 file or the exif segment of a jpeg file,
+             -1 for a jpeg file without exif data and None for unsupported formats
+    '''
+    if data[0:2] in (b'II', b'MM'):
+        return 0
+    if data[0:2] != b'\xff\xd8':
+        return None
+    position = 2
+    while position + 4 <= len(data):
+        marker = data[position:position+2]
+        if marker[0] != 0xff or marker == b'\xff\xda':  # start of scan, no exif in front of the image data
+            return -1
+        length = int.from_bytes(data[position+2:position+4], 'big')
+        if marker == b'\xff\xe1' and data[position+4:position+10] == b'Exif\x00\x00':
+            return position + 10
+        position += 2 + length
+    raise Truncated()
+
+
+def read_ifd(data, base, offset, endian, wanted):
+    '''
+    Reads the wanted tags (tag id -> tag name) of the ifd at offset.
+    :return: dict of tag name -> value, dict of tag id -> value of the sub ifd pointers and the offset of the next ifd
+    '''
+    def unpack(fmt, position, size):
+        if base + position + size > len(data):
+            raise Truncated()
+        return struct.unpack_from(endian + fmt, data, base + position)
+
+    values = {}
+    pointers = {}
+    entries = unpack('H', offset, 2)[0]
+    for i in range(entries):
+        entry = offset + 2 + 12 * i
+        tag, field_type, field_count = unpack('HHL', entry, 8)
+        if (tag not in wanted and tag not in (EXIF_OFFSET, GPS_OFFSET)) or field_type not in field_types:
+            continue
+        fmt, size = field_types[field_type]
+        position = entry + 8
+        if size * field_count > 4:
+            position = unpack('L', position, 4)[0]
+        if field_type == 2:
+            value = unpack('{}s'.format(field_count), position, field_count)[0].split(b'\x00', 1)[0]
+            try:
+                value = value.decode('utf-8')
+            except UnicodeDecodeError:
+                pass
+        elif field_type in (5, 10):
+            raw = unpack('{}{}'.format(2 * field_count, fmt), position, size * field_count)
+            value = [ num / den if num and den else 0 for num, den in zip(raw[0::2], raw[1::2]) ]
+        else:
+            value = list(unpack('{}{}'.format(field_count, fmt), position, size * field_count))
+        if tag in wanted:
+            values[wanted[tag]] = value
+        else:
+            pointers[tag] = value[0]
+    next_ifd = unpack('L', offset + 2 + 12 * entries, 4)[0]
+    return values, pointers, next_ifd
+
+
+def read_exif_fields(data, tags):
+    '''
+    Reads the given exif tags ('<ifd> <tag name>' like exifread) from the tiff header in data,
+    without parsing anything else (maker notes, thumbnails, other tags).
+    :return: dict of tag -> value like serialize_exif_data or None if the format is not supported
+    :raises Truncated: if data ends before all ifds are read
+    '''
+    base = find_tiff_header(data)
+    if base is None:
+        return None
+    if base == -1:
+        return {}
+    if len(data) < base + 8:
+        raise Truncated()
+    endian = '<' if data[base:base+2] == b'II' else '>'
+
+    wanted = {}
+    for tag in tags:
+        ifd_name, tag_name = tag.split(' ', 1)
+        if ifd_name in tag_ids and tag_name in tag_ids[ifd_name]:
+            wanted.setdefault(ifd_name, {})[tag_ids[ifd_name][tag_name]] = tag
+
+    fields = {}
+    values, pointers, next_ifd = read_ifd(data, base, struct.unpack_from(endian + 'L', data, base + 4)[0], endian, wanted.get('Image', {}))
+    fields.update(values)
+    if 'Thumbnail' in wanted and next_ifd:
+        fields.update(read_ifd(data, base, next_ifd, endian, wanted['Thumbnail'])[0])
+    if 'EXIF' in wanted and EXIF_OFFSET in pointers:
+        fields.update(read_ifd(data, base, pointers[EXIF_OFFSET], endian, wanted['EXIF'])[0])
+    if 'GPS' in wanted and GPS_OFFSET in pointers:
+        fields.update(read_ifd(data, base, pointers[GPS_OFFSET], endian, wanted['GPS'])[0])
+    return fields
+
+
+def read_header(source, size=header_size):
+    with open(source, 'rb') as f:
+        data = f.read(size)
+    count('bytes_read', len(data))
+    return data
+
+
+def read_meta_fields(source, tags, header=None):
+    '''
+    Reads the given exif tags of source, only the header of the file is read if possible.
+    Maker note tags are only parsed (the slow way) if the file has a maker note and none of the other tags of their group are found,
+    tags is a list of these groups (lists of tags in order of preference).
+    '''
+    all_tags = [ tag for group in tags for tag in group ]
+    data = header if header is not None else read_header(source)
+    try:
+        fields = read_exif_fields(data, all_tags + ['EXIF MakerNote'])
+    except (Truncated, struct.error):
+        fields = None
+        if len(data) == header_size:  # the exif data exceeds the header, read the whole file
+            try:
+                with open(source, 'rb') as f:
+                    fields = read_exif_fields(CountingFile(f).read(), all_tags + ['EXIF MakerNote'])
+            except (Truncated, struct.error):
+                pass
+    if fields is None:  # unsupported format, fall back to exifread
+        return serialize_exif_data(read_exif_data(source), all_tags)
+
+    makernote_tags = [ tag for group in tags if not any( tag in fields for tag in group ) for tag in group if tag.startswith('MakerNote ') ]
+    if fields.pop('EXIF MakerNote', None) and makernote_tags:
+        fields.update(serialize_exif_data(read_exif_data(source), makernote_tags))
+    return fields
+
+
+def read_preview(source, header=None):
+    '''
+    :return: the embedded JPEG preview of a tiff based raw file (the image of IFD0 of a CR2) or None
+    '''
+    data = header if header is not None else read_header(source)
+    if data[0:2] not in (b'II', b'MM'):
+        return None
+    try:
+        fields = read_exif_fields(data, ['Image StripOffsets', 'Image StripByteCounts'])
+    except (Truncated, struct.error):
+        return None
+    if 'Image StripOffsets' not in fields or 'Image StripByteCounts' not in fields:
+        return None
+    with open(source, 'rb') as f:
+        f.seek(fields['Image StripOffsets'][0])
+        preview = f.read(fields['Image StripByteCounts'][0])
+    count('bytes_read', len(preview))
+    if preview[0:2] != b'\xff\xd8':  # uncompressed strips of a plain tiff
+        return None
+    return preview
+
+
+def read_thumbnail(source, header=None):
+    '''
+    :return: the JPEG thumbnail embedded in the exif data (IFD1) of source or None, only the header of the file is read
+    '''
+    data = header if header is not None else read_header(source)
+    try:
+        fields = read_exif_fields(data, ['Thumbnail JPEGInterchangeFormat', 'Thumbnail JPEGInterchangeFormatLength'])
+    except (Truncated, struct.error):
+        return None
+    if not fields or 'Thumbnail JPEGInterchangeFormat' not in fields or 'Thumbnail JPEGInterchangeFormatLength' not in fields:
+        return None
+    start = find_tiff_header(data) + fields['Thumbnail JPEGInterchangeFormat'][0]
+    length = fields['Thumbnail JPEGInterchangeFormatLength'][0]
+    thumbnail = data[start:start+length]
+    if len(thumbnail) != length or thumbnail[0:2] != b'\xff\xd8':  # beyond the header or no JPEG
+        return None
+    return thumbnail
+
+
+def read_full_exif(source):
+    return serialize_exif_data(read_exif_data(source), ['EXIF', 'GPS', 'Image', 'Thumbnail'])
+
+
 def convert_exif_location_decimal(exif_data):
     return location_ops.convert_to_decimal(
             exif_data['GPS GPSLatitudeRef'], exif_data['GPS GPSLatitude'][0], exif_data['GPS GPSLatitude'][1], exif_data['GPS GPSLatitude'][2],
@@ -1,5 +1,12 @@
+import io
+import numpy
 import face_recognition
 import cv2
+from PIL import Image
+from exif_ops import read_preview
+
+# bump when the detection changes, cached results of other versions are detected again
+detector_version = 1
 
 try:
     preview_enabled
@@ -11,12 +18,34 @@ def show_preview(enabled):
     preview_enabled = enabled
 
 
-def detect_faces(path):
-    image = face_recognition.load_image_file(path)
+def detector_params(max_size, upsample=1, model='hog'):
+    return {'version': detector_version, 'max_size': max_size, 'upsample': upsample, 'model': model}
+
+
+def load_image(path, max_size=0):
+    '''
+    Decodes path (the embedded JPEG preview for raw files like CR2) with at most max_size pixels on the longer side,
+    JPEGs are decoded at a reduced scale by the DCT (draft mode) instead of decoding the full image and resizing it.
+    :return: RGB image array and the factor to scale coordinates of the image to the full size
+    '''
+    preview = read_preview(path)
+    image = Image.open(io.BytesIO(preview) if preview else path)
+    full_width, full_height = image.size
+    if max_size and max(image.size) > max_size:
+        ratio = max_size / max(image.size)
+        image.draft('RGB', (int(full_width * ratio) + 1, int(full_height * ratio) + 1))
+    image = image.convert('RGB')
+    if max_size and max(image.size) > max_size:
+        image.thumbnail((max_size, max_size), Image.BILINEAR)
+    return numpy.asarray(image), full_width / image.size[0]
+
+
+def detect_faces(path, params=detector_params(0)):
+    image, scale = load_image(path, params['max_size'])
     if preview_enabled:
         image_preview = image.copy()
 
-    face_locations = face_recognition.face_locations(image)
+    face_locations = face_recognition.face_locations(image, number_of_times_to_upsample=params['upsample'], model=params['model'])
     face_encodings = face_recognition.face_encodings(image, face_locations)
 
     summary = []
@@ -24,5 +53,7 @@ def detect_faces(path):
         if preview_enabled:
             cv2.rectangle(image_preview, (left, top), (right, bottom), (0, 0, 255), 2)
             cv2.imshow('preview', image_preview[:,:,::-1])
+        # boxes in full size coordinates
+        top, right, bottom, left = [ int(round(value * scale)) for value in (top, right, bottom, left) ]
         summary.append({'top':top, 'right': right, 'bottom': bottom, 'left': left, 'encoding': face_encoding})
     return summary
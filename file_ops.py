@@ -1,10 +1,43 @@
 import os
+import fcntl
 import hashlib
+import mmap
 import exifread
 import shutil
 import re
 import location_ops
+from basic_ops import count
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+ingest_block_size = 1048576
+ingest_header_size = 131072
+partial_size = 65536
+
+placement_strategies = ['auto', 'copy', 'move-rename', 'reflink', 'hardlink']
+
+# content id algorithms, blake2b-tree hashes the leaves of large files on all cores
+hash_algorithms = ['sha512', 'blake2b', 'blake2b-tree']
+tree_leaf_size = 16777216
+tree_executor = None
+FICLONE = 0x40049409  # linux/fs.h, supported by btrfs, XFS and others
+
+
+class CountingFile:
+    # counts the bytes consumed by readers like exifread, which seek around in the file
+    def __init__(self, f):
+        self.f = f
+
+    def read(self, size=-1):
+        data = self.f.read(size)
+        count('bytes_read', len(data))
+        return data
+
+    def seek(self, *args):
+        return self.f.seek(*args)
+
+    def tell(self):
+        return self.f.tell()
 
 
 def prepare_dest(dest_dir):
@@ -12,21 +45,242 @@ def prepare_dest(dest_dir):
         os.makedirs(directory, exist_ok=True)
 
 
-def iter_files(paths, valid_extensions):
-    for path in paths:
-        for folder, _, files in os.walk(path):
-            for filename in files:
-                filename = os.path.join(folder, filename)
-                if os.path.splitext(filename)[-1].lower() in valid_extensions:
-                    yield(filename)
+def signature_size(signature):
+    # dev:ino:size:mtime_ns:path
+    return int(signature.split(':', 3)[2])
+
+
+def partial_digest(filename):
+    '''
+    Cheap digest of the first and last partial_size bytes (the whole file if smaller) to tell files of the same size apart.
+    '''
+    with open(filename, 'rb') as f:
+        data = f.read(partial_size)
+        if len(data) == partial_size:
+            f.seek(max(partial_size, os.fstat(f.fileno()).st_size - partial_size))
+            data += f.read(partial_size)
+    count('bytes_read', len(data))
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+def file_signature(filename, stat):
+    # key of the source manifest, changes with the content in all practical cases
+    return '{}:{}:{}:{}:{}'.format(stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns, filename)
+
+
+class TreeHash:
+    '''
+    blake2b in tree mode with a depth of 2: the file is split into leaves of tree_leaf_size bytes,
+    which are hashed independently, the root node hashes the concatenated leaf digests.
+    Incremental like the hashlib objects, content_digest hashes the leaves in parallel instead.
+    '''
+    def __init__(self):
+        self.leaves = []
+        self.leaf = None
+        self.leaf_length = 0
+
+    @staticmethod
+    def leaf_hash(index, data=b''):
+        return hashlib.blake2b(data, fanout=0, depth=2, leaf_size=tree_leaf_size, inner_size=64, node_offset=index, node_depth=0)
+
+    @staticmethod
+    def root_digest(leaves):
+        root = hashlib.blake2b(fanout=0, depth=2, leaf_size=tree_leaf_size, inner_size=64, node_depth=1, last_node=True)
+        for leaf in leaves:
+            root.update(leaf)
+        return root.hexdigest()
+
+    def update(self, data):
+        data = memoryview(data)
+        while data:
+            if self.leaf is None:
+                self.leaf = self.leaf_hash(len(self.leaves))
+                self.leaf_length = 0
+            length = min(len(data), tree_leaf_size - self.leaf_length)
+            self.leaf.update(data[:length])
+            self.leaf_length += length
+            data = data[length:]
+            if self.leaf_length == tree_leaf_size:
+                self.leaves.append(self.leaf.digest())
+                self.leaf = None
+
+    def hexdigest(self):
+        return self.root_digest(self.leaves + ([self.leaf.digest()] if self.leaf else []))
 
 
-def sha512sum_file(filename):
+def new_hash(algorithm):
+    if algorithm == 'sha512':
+        return hashlib.sha512()
+    if algorithm == 'blake2b':
+        return hashlib.blake2b()
+    if algorithm == 'blake2b-tree':
+        return TreeHash()
+    raise ValueError('Unknown hash algorithm {}'.format(algorithm))
+
+
+def tree_leaf_digest(view, index):
+    return TreeHash.leaf_hash(index, view[index*tree_leaf_size:(index+1)*tree_leaf_size]).digest()
+
+
+def content_digest(filename, algorithm='sha512', buffer_size=0):
+    '''
+    Hashes the content of filename, the file is mapped into memory (buffer_size 0) or read in blocks of buffer_size.
+    hashlib releases the GIL while hashing the large buffers, so the leaves of blake2b-tree are hashed by threads.
+    :return: the content id (hex digest)
+    '''
+    global tree_executor
     with open(filename, 'rb') as f:
-        sha512 = hashlib.sha512()
-        for block in iter(lambda: f.read(32768), b''):
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:  # can't be mapped
+            return new_hash(algorithm).hexdigest()
+        if buffer_size:
+            content_hash = new_hash(algorithm)
+            buffer = bytearray(buffer_size)
+            view = memoryview(buffer)
+            while True:
+                length = f.readinto(buffer)
+                if not length:
+                    break
+                content_hash.update(view[:length])
+            count('bytes_read', size)
+            return content_hash.hexdigest()
+
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            if hasattr(data, 'madvise'):
+                data.madvise(mmap.MADV_SEQUENTIAL)
+            view = memoryview(data)
+            try:
+                if algorithm == 'blake2b-tree' and size > tree_leaf_size:
+                    if tree_executor is None:
+                        tree_executor = ThreadPoolExecutor(os.cpu_count())
+                    leaves = list(tree_executor.map(lambda index: tree_leaf_digest(view, index), range((size - 1) // tree_leaf_size + 1)))
+                    digest = TreeHash.root_digest(leaves)
+                else:
+                    content_hash = new_hash(algorithm)
+                    content_hash.update(view)
+                    digest = content_hash.hexdigest()
+            finally:
+                view.release()
+    count('bytes_read', size)
+    return digest
+
+
+def placing_path(destination):
+    # temporary file next to destination, renamed into place once complete so a crash never leaves a partial file
+    return os.path.join(os.path.dirname(destination), '.placing_{}'.format(os.getpid()))
+
+
+def copy_file(source, destination):
+    tmp_path = placing_path(destination)
+    try:
+        with open(source, 'rb') as src, open(tmp_path, 'wb') as dst:
+            try:
+                # let the kernel copy (or clone) the data without passing it through user space
+                while os.copy_file_range(src.fileno(), dst.fileno(), ingest_block_size) > 0:
+                    pass
+            except OSError:
+                src.seek(0); dst.seek(0); dst.truncate()
+                for block in iter(lambda: src.read(ingest_block_size), b''):
+                    dst.write(block)
+            dst.flush()
+            size = os.fstat(dst.fileno()).st_size
+        shutil.copystat(source, tmp_path)
+        os.rename(tmp_path, destination)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    count('bytes_read', size)
+    count('bytes_written', size)
+
+
+def reflink_file(source, destination):
+    tmp_path = placing_path(destination)
+    try:
+        with open(source, 'rb') as src, open(tmp_path, 'wb') as dst:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+        shutil.copystat(source, tmp_path)
+        os.rename(tmp_path, destination)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def resolve_placement(source, raw_dir, strategy, move_file):
+    '''
+    Returns the placement strategies to try in order, the chunked copy always comes last.
+    auto prefers a rename (when moving) or a copy on write clone and a hard link (when copying),
+    as long as source and destination live on the same device.
+    '''
+    if strategy == 'auto':
+        if os.stat(source).st_dev != os.stat(raw_dir).st_dev:
+            return ['copy']
+        if move_file:
+            return ['move-rename', 'copy']
+        return ['reflink', 'hardlink', 'copy']
+    if strategy == 'copy':
+        return ['copy']
+    return [strategy, 'copy']
+
+
+def place_file(source, destination, strategies):
+    '''
+    Places source at destination using the first working strategy, errors of the last strategy
+    (the copy) are raised, the source must not be removed then.
+    :return: the used strategy
+    '''
+    size = os.stat(source).st_size
+    for strategy in strategies[:-1]:
+        try:
+            if strategy == 'move-rename':
+                os.rename(source, destination)
+            elif strategy == 'reflink':
+                reflink_file(source, destination)
+            elif strategy == 'hardlink':
+                os.link(source, destination)
+        except OSError:
+            continue
+        count('bytes_avoided', size)
+        count('placed_' + strategy, 1)
+        return strategy
+    copy_file(source, destination)
+    count('bytes_copied', size)
+    count('placed_copy', 1)
+    return 'copy'
+
+
+def ingest_file(source, store, write=True):
+    '''
+    Reads source exactly once: the data is hashed and written to a temporary file in the raw dir of the content store,
+    which is renamed to its path in the store afterwards (or dropped if this content is already stored).
+    With write=False the data is only hashed, to be placed by a zero copy strategy afterwards.
+    :return: the content id (hashed by the algorithm of the store) and the first ingest_header_size bytes for exif parsing
+    '''
+    header = b''
+    sha512 = new_hash(store.algorithm)
+    tmp_path = os.path.join(store.raw_dir, '.ingest_{}'.format(os.getpid()))
+    with open(source, 'rb') as f, open(tmp_path if write else os.devnull, 'wb') as tmp:
+        for block in iter(lambda: f.read(ingest_block_size), b''):
+            count('bytes_read', len(block))
             sha512.update(block)
-        return sha512.hexdigest()
+            if write:
+                tmp.write(block)
+                count('bytes_written', len(block))
+            if len(header) < ingest_header_size:
+                header += block[:ingest_header_size-len(header)]
+    sha512 = sha512.hexdigest()
+    if not write:
+        return sha512, header
+    hashed_path = store.path(sha512, create=True)
+    if os.path.exists(hashed_path):
+        os.remove(tmp_path)
+    else:
+        shutil.copystat(source, tmp_path)
+        os.rename(tmp_path, hashed_path)
+        count('bytes_copied', os.stat(hashed_path).st_size)
+        count('placed_copy', 1)
+    return sha512, header
 
 
 def link_file(source, destination):
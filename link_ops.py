@@ -0,0 +1,116 @@
+import os
+import pickle
+from basic_ops import atomic_write
+
+# link trees at the destination completely managed by the link planner
+link_roots = ['by_date', 'by_camera_model', 'by_author', 'by_location', 'by_person', 'near_duplicates']
+
+
+def link_target(link_path, target_path):
+    '''
+    Returns the relative symlink content pointing from link_path to target_path (both relative to the destination).
+    '''
+    return '../' * link_path.count('/') + target_path
+
+
+def scan_links(dest_dir):
+    '''
+    Sweeps the link trees with scandir.
+    :return: dict of link path -> symlink content and set of directories, all paths relative to dest_dir
+    '''
+    links = {}
+    dirs = set()
+    stack = [ root for root in link_roots if os.path.isdir(os.path.join(dest_dir, root)) ]
+    while stack:
+        directory = stack.pop()
+        dirs.add(directory)
+        with os.scandir(os.path.join(dest_dir, directory)) as entries:
+            for entry in entries:
+                path = directory + '/' + entry.name
+                if entry.is_symlink():
+                    links[path] = os.readlink(entry.path)
+                elif entry.is_dir():
+                    stack.append(path)
+    return links, dirs
+
+
+def load_snapshot(dest_dir, rescan=False):
+    '''
+    Returns the links and directories of the last run, or sweeps the trees if there is no snapshot or rescan is set.
+    '''
+    snapshot_path = os.path.join(dest_dir, 'link_snapshot.pickle')
+    if not rescan and os.path.exists(snapshot_path):
+        with open(snapshot_path, 'rb') as f:
+            return pickle.load(f)
+    return scan_links(dest_dir)
+
+
+def save_snapshot(dest_dir, links, dirs):
+    snapshot_path = os.path.join(dest_dir, 'link_snapshot.pickle')
+    with atomic_write(snapshot_path, 'wb') as f:
+        pickle.dump((links, dirs), f, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def split_links(links, roots):
+    '''
+    :return: the links below the given roots and the other links
+    '''
+    inside = {}
+    outside = {}
+    for path, target in links.items():
+        (inside if path.split('/', 1)[0] in roots else outside)[path] = target
+    return inside, outside
+
+
+def diff_links(desired, existing):
+    '''
+    :return: lists of link paths to create, delete and retarget
+    '''
+    creates = [ path for path in desired if path not in existing ]
+    deletes = [ path for path in existing if path not in desired ]
+    retargets = [ path for path in desired if path in existing and existing[path] != desired[path] ]
+    return creates, deletes, retargets
+
+
+def apply_links(dest_dir, desired, existing, dirs):
+    '''
+    Reconciles the link trees at dest_dir with the desired links,
+    only the differing links are touched and every missing directory is created once.
+    :return: number of created, deleted and retargeted links and the directories after the changes
+    '''
+    creates, deletes, retargets = diff_links(desired, existing)
+
+    for path in deletes + retargets:
+        try:
+            os.remove(os.path.join(dest_dir, path))
+        except FileNotFoundError:
+            pass
+
+    # remove directories emptied by the deletes, the link roots are kept
+    for directory in sorted(set( os.path.dirname(path) for path in deletes ), key=len, reverse=True):
+        while directory not in link_roots and directory in dirs:
+            try:
+                os.rmdir(os.path.join(dest_dir, directory))
+            except OSError:
+                break
+            dirs.discard(directory)
+            directory = os.path.dirname(directory)
+
+    for directory in sorted(set( os.path.dirname(path) for path in creates ) - dirs):
+        os.makedirs(os.path.join(dest_dir, directory), exist_ok=True)
+        while directory and directory not in dirs:
+            dirs.add(directory)
+            directory = os.path.dirname(directory)
+
+    for path in creates + retargets:
+        link_path = os.path.join(dest_dir, path)
+        try:
+            os.symlink(desired[path], link_path)
+        except FileExistsError:  # not part of a stale snapshot
+            os.remove(link_path)
+            os.symlink(desired[path], link_path)
+        except FileNotFoundError:  # removed by a run interrupted before it saved its snapshot
+            os.makedirs(os.path.dirname(link_path), exist_ok=True)
+            os.symlink(desired[path], link_path)
+
+    return len(creates), len(deletes), len(retargets), dirs
@@ -1,49 +1,112 @@
+import os
+import json
+import multiprocessing
+import numpy
 import gpxpy
 import unicodedata
 import reverse_geocoder
+from basic_ops import atomic_write
 
 
 try:
     database
 except NameError:
-    database = {'times': [], 'points': {}}
+    database = {'times': numpy.empty(0), 'latitudes': numpy.empty(0), 'longitudes': numpy.empty(0), 'path': None}
     print('Location operations initiated')
 
+gpx_index_columns = ['times', 'latitudes', 'longitudes']
 
-def parse_gpx_file(filename):
+
+def read_gpx_file(filename):
+    points = []
     with open(filename, 'r') as gpx_file:
         gpx = gpxpy.parse(gpx_file)
         for track in gpx.tracks:
             for segment in track.segments:
                 for point in segment.points:
                     try:
-                        timestamp = point.time.timestamp()
-                        if timestamp not in database['times']:
-                            latitude = point.latitude
-                            longitude = point.longitude
-                            database['times'].append(timestamp)
-                            database['points'][timestamp] = {'latitude': latitude, 'longitude': longitude}
+                        points.append((point.time.timestamp(), point.latitude, point.longitude))
                     except AttributeError:
                         pass
-    database['times'].sort()
-
-
-def get_gpx_location(timestamp, max_diff):
-    if len(database['times']) < 2 or timestamp < database['times'][0] or timestamp > database['times'][-1]:
-        return (None, None)
-    for i in range(0, len(database['times'])-1):
-        t_gpx_1 = database['times'][i]
-        t_gpx_2 = database['times'][i+1]
-        if timestamp >= t_gpx_1 and timestamp <= t_gpx_2:
-            if ( timestamp - t_gpx_1 ) > max_diff or ( t_gpx_2 - timestamp ) > max_diff:
-                break
-            latitude_1 = database['points'][t_gpx_1]['latitude']; longitude_1 = database['points'][t_gpx_1]['longitude']
-            latitude_2 = database['points'][t_gpx_2]['latitude']; longitude_2 = database['points'][t_gpx_2]['longitude']
-            fak = ( timestamp - t_gpx_1 ) / ( t_gpx_2 - t_gpx_1 )
-            latitude = ( latitude_2 - latitude_1 ) * fak + latitude_1
-            longitude = ( longitude_2 - longitude_1 ) * fak + longitude_1
-            return (latitude, longitude)
-    return (None, None)
+    return points
+
+
+def build_gpx_index(filenames, num_threads=4):
+    points = []
+    with multiprocessing.Pool(num_threads) as pool:
+        for file_points in pool.imap(read_gpx_file, filenames):
+            points += file_points
+    points = numpy.array(points, dtype=numpy.float64).reshape(-1, 3)
+    # sort by time and keep the first point seen for every timestamp
+    points = points[numpy.argsort(points[:, 0], kind='stable')]
+    _, first = numpy.unique(points[:, 0], return_index=True)
+    points = points[first]
+    return {'times': points[:, 0], 'latitudes': points[:, 1], 'longitudes': points[:, 2]}
+
+
+def gpx_files_signature(filenames):
+    signature = []
+    for filename in sorted(filenames):
+        stat = os.stat(filename)
+        signature.append([filename, stat.st_size, stat.st_mtime_ns])
+    return signature
+
+
+def update_gpx_index(index_dir, filenames, num_threads=4):
+    '''
+    Writes the gpx track index of the given files to index_dir as one .npy file per column,
+    the index is rebuilt only if the gpx files differ from the ones it was built from.
+    :return: True if the index was rebuilt
+    '''
+    signature = gpx_files_signature(filenames)
+    signature_path = os.path.join(index_dir, 'signature.json')
+    if os.path.exists(signature_path):
+        with open(signature_path, 'r') as f:
+            if json.load(f) == signature:
+                return False
+    os.makedirs(index_dir, exist_ok=True)
+    index = build_gpx_index(filenames, num_threads)
+    for column in gpx_index_columns:
+        with atomic_write(os.path.join(index_dir, column + '.npy'), 'wb') as f:
+            numpy.save(f, index[column])
+    with open(signature_path, 'w') as f:
+        json.dump(signature, f)
+    return True
+
+
+def open_gpx_index(index_dir):
+    '''
+    Maps the gpx track index read only into this process,
+    all processes share the same pages of the memory mapped files.
+    '''
+    if database['path'] == index_dir:
+        return
+    for column in gpx_index_columns:
+        database[column] = numpy.load(os.path.join(index_dir, column + '.npy'), mmap_mode='r')
+    database['path'] = index_dir
+
+
+def get_gpx_locations(timestamps, max_diff):
+    '''
+    Interpolates the locations of all timestamps between the surrounding track points.
+    Timestamps outside the tracks or more than max_diff seconds away from a track point get nan.
+    :return: arrays of latitudes and longitudes
+    '''
+    times = database['times']
+    timestamps = numpy.asarray(timestamps, dtype=numpy.float64)
+    latitudes = numpy.full(timestamps.shape, numpy.nan)
+    longitudes = numpy.full(timestamps.shape, numpy.nan)
+    if len(times) < 2:
+        return latitudes, longitudes
+
+    i = numpy.clip(numpy.searchsorted(times, timestamps, side='left') - 1, 0, len(times) - 2)
+    t_gpx_1 = times[i]; t_gpx_2 = times[i+1]
+    valid = (timestamps >= times[0]) & (timestamps <= times[-1]) & \
+            (timestamps - t_gpx_1 <= max_diff) & (t_gpx_2 - timestamps <= max_diff)
+    fak = ( timestamps[valid] - t_gpx_1[valid] ) / ( t_gpx_2[valid] - t_gpx_1[valid] )
+    latitudes[valid] = ( database['latitudes'][i+1][valid] - database['latitudes'][i][valid] ) * fak + database['latitudes'][i][valid]
+    longitudes[valid] = ( database['longitudes'][i+1][valid] - database['longitudes'][i][valid] ) * fak + database['longitudes'][i][valid]
+    return latitudes, longitudes
 
 
 def convert_to_decimal(lat_dir, lat_deg, lat_min, lat_sec, lon_dir, lon_deg, lon_min, lon_sec):
@@ -53,9 +116,7 @@ def convert_to_decimal(lat_dir, lat_deg, lat_min, lat_sec, lon_dir, lon_deg, lon
     return (lat_deg, lon_deg)
 
 
-def get_location_info(latitude, longitude, normalize=False):
-    raw = reverse_geocoder.get((latitude,longitude), mode=1, verbose=False)
-
+def location_path(raw, normalize=False):
     path = [ '_none_' ]
 
     if len(raw['cc']) > 0:
@@ -70,5 +131,29 @@ def get_location_info(latitude, longitude, normalize=False):
     path = [ part.replace(' ', '_') for part in path ]
     if normalize:
         path = [ unicodedata.normalize('NFKD', part).encode('ascii','ignore') for part in path ]
+    return path
+
+
+def get_location_info(latitude, longitude, normalize=False):
+    raw = reverse_geocoder.get((latitude,longitude), mode=1, verbose=False)
+    return {'latitude': latitude, 'longitude': longitude, 'raw': raw, 'path': location_path(raw, normalize)}
+
+
+def location_key(latitude, longitude):
+    # ~100m grid, far below the distance between two places of the geocoder table
+    return '{:.3f},{:.3f}'.format(latitude, longitude)
+
 
-    return {'latitude': latitude, 'longitude': longitude, 'raw': raw, 'path': path}
+def get_location_paths(keys, batch_size=100000):
+    '''
+    Reverse geocodes the given location keys in large batched kd-tree queries.
+    :return: dict of location key to location path
+    '''
+    paths = {}
+    keys = list(keys)
+    for i in range(0, len(keys), batch_size):
+        batch = keys[i:i+batch_size]
+        coordinates = [ tuple(float(part) for part in key.split(',')) for key in batch ]
+        for key, raw in zip(batch, reverse_geocoder.search(coordinates, mode=1, verbose=False)):
+            paths[key] = location_path(raw)
+    return paths
@@ -1,183 +1,487 @@
-import os, re, shutil
-import location_ops, db_ops, face_ops
+import os, re, math
+import location_ops, db_ops, phash_ops
 from basic_ops import *
 from datetime import datetime
-from file_ops import sha512sum_file, link_file
-from exif_ops import read_exif_data, convert_exif_location_decimal, serialize_exif_data
+from link_ops import link_target
+from content_ops import walk_files
+from file_ops import content_digest, partial_digest, signature_size, link_file, ingest_file, resolve_placement, place_file
+from exif_ops import read_meta_fields, read_full_exif, convert_exif_location_decimal
+from meta_ops import MetaRecord, parse_date
 
 keyword_map = {
         'by_camera_model': ['Image Model', 'Image Make', 'MakerNote ImageType'],
         'by_author': ['Image Artist', 'MakerNote OwnerName', 'EXIF CameraOwnerName', 'Thumbnail Artist']
         }
 
+# exif tags read into the meta data, as groups of alternative tags
+meta_tags = [ ['Image DateTimeOriginal', 'Image DateTime', 'EXIF DateTimeDigitized'],
+        ['GPS GPSLatitudeRef'], ['GPS GPSLatitude'], ['GPS GPSLongitudeRef'], ['GPS GPSLongitude'] ] + list(keyword_map.values())
+
 
 def prepare_dest(dest_dir):
     for directory in [ os.path.join(dest_dir, sub_dir) for sub_dir in ['hashed/with_extension', 'by_date', 'hashed/raw', 'by_location/_unknown_', 'by_person/_all_'] ]:
         os.makedirs(directory, exist_ok=True)
 
 
-def hash_file(source, dest_dir):
+def lookup_manifest(entries, store, db_manifest, chunk_size=1000):
+    '''
+    Yields the scanned (source, signature) entries with the content id the manifest knows for their signature
+    (None for new or changed files), looked up in batches of chunk_size.
+    The manifest is only flushed by --full-rescan, so unchanged files are never read again.
+    '''
+    chunk = []
+    for entry in entries:
+        chunk.append(entry)
+        if len(chunk) >= chunk_size:
+            yield from lookup_manifest_chunk(chunk, store, db_manifest)
+            chunk = []
+    yield from lookup_manifest_chunk(chunk, store, db_manifest)
+
+
+def lookup_manifest_chunk(chunk, store, db_manifest):
+    content_ids = db_ops.get_many(db_manifest, [ store.manifest_key(signature) for _, signature in chunk ])
+    return [ (source, signature, content_id) for (source, signature), content_id in zip(chunk, content_ids) ]
+
+
+def hash_file(entry, store, db_manifest, db_size, partial_match):
+    source, signature, sha512 = entry
     basename = os.path.basename(source)
-    source = os.path.abspath(source)
-    sha512 = sha512sum_file(source)
-    extension = os.path.splitext(source)[1]
 
-    if extension == '.gpx':
-        location_ops.parse_gpx_file(source)
-        return basename, None, None
+    if sha512 is None:
+        if partial_match:
+            sha512 = match_partial(source, signature_size(signature), store, db_size)
+        if sha512 is None:
+            with timer('hash'):
+                sha512 = content_digest(source, store.algorithm)
+            add_to_size_index(db_size, signature_size(signature), sha512)
+        db_ops.defer(db_manifest, store.manifest_key(signature), sha512)
+    else:
+        count('cache_hits', 1)
 
     return basename, source, sha512
 
 
-def copy_move_file(entry, dest_dir, move_file):
+def match_partial(source, size, store, db_size):
+    '''
+    Looks for stored content of the same size with the same first and last 64 KiB (--partial-match),
+    the partial digests of the stored files are computed on first use and kept in the size index.
+    :return: the content id or None
+    '''
+    bucket = db_ops.get(db_size, str(size))
+    if not bucket:  # unique size, new content
+        return None
+    with timer('hash'):
+        partial = partial_digest(source)
+    match = None
+    updated = {}
+    for content_id, stored_partial in bucket.items():
+        if not store.exists(content_id):
+            continue
+        if stored_partial is None:
+            with timer('hash'):
+                stored_partial = updated[content_id] = partial_digest(store.path(content_id))
+        if stored_partial == partial:
+            match = content_id
+            break
+    if updated:
+        db_ops.defer(db_size, str(size), updated, merge=True)
+    if match:
+        count('partial_matched', 1)
+    return match
+
+
+def add_to_size_index(db_size, size, content_id):
+    # merged into the bucket by the main process, a partial digest computed meanwhile is kept
+    db_ops.defer(db_size, str(size), {content_id: None}, merge=True)
+
+
+def index_stored_sizes(store, db_size, chunk_size=1000):
+    '''
+    Adds all files of the content store to the size index (size -> {content id: partial digest}) once,
+    only their sizes are read, files stored later are added when they are hashed.
+    :return: number of indexed files
+    '''
+    if db_ops.get(db_size, 'indexed'):
+        return 0
+    buckets = {}
+    for root, name in walk_files(store.raw_dir):
+        buckets.setdefault(str(os.stat(os.path.join(root, name)).st_size), {})[name] = None
+    sizes = list(buckets)
+    for i in range(0, len(sizes), chunk_size):
+        chunk = sizes[i:i+chunk_size]
+        for size, bucket in zip(chunk, db_ops.get_many(db_size, chunk)):
+            buckets[size].update(bucket or {})
+        db_ops.set_many(db_size, [ (size, buckets[size]) for size in chunk ])
+    db_ops.set(db_size, 'indexed', True)
+    return sum( len(bucket) for bucket in buckets.values() )
+
+
+def copy_move_file(entry, store, move_file, placement):
     source = entry[0]
     sha512 = entry[1]
 
     basename = os.path.basename(source)
     extension = os.path.splitext(source)[1]
 
-    hashed_path = os.path.join(dest_dir, 'hashed/raw', sha512)
-    hashed_path_extension = os.path.join(dest_dir, 'hashed/with_extension', sha512 + extension)
+    strategy = 'already stored'
+    hashed_path = store.path(sha512, create=True)
+    hashed_path_extension = store.path_with_extension(sha512, extension, create=True)
     if not os.path.exists(hashed_path):
-        shutil.copy2(source, hashed_path)
+        with timer('copy'):
+            strategy = place_file(source, hashed_path, resolve_placement(source, store.raw_dir, placement, move_file))
+    else:
+        count('skipped', 1)
     if not os.path.exists(hashed_path_extension):
         link_file(hashed_path, hashed_path_extension)
-    if move_file and not dest_dir == source[0:len(dest_dir)]:  # don't remove from destination directory
-        os.remove(source)
-        try:
-            os.rmdir(os.path.split(source)[0])
-        except OSError:
-            pass
-    return basename, sha512, None
+    if move_file:
+        remove_source(source, store.dest_dir)
+    return '{} ({})'.format(basename, strategy), sha512, None
 
 
-def get_meta_data(entry, dest_dir, max_diff):
-    source = entry[0]
-    sha512 = entry[1]
-
+def ingest_source(entry, store, move_file, placement, db_manifest, db_meta, db_exif, db_size, partial_match, full_rescan):
+    source, signature, sha512 = entry
     basename = os.path.basename(source)
-    hashed_path = os.path.join(dest_dir, 'hashed/raw', sha512)
-
-    meta_data = read_exif_data(hashed_path)
-    meta_data = serialize_exif_data(meta_data, ['EXIF', 'GPS', 'Image', 'Thumbnail'])
-    meta_data['original_name'] = basename
-    if 'GPS GPSLatitudeRef' in meta_data:
-        latitude, longitude = convert_exif_location_decimal(meta_data)
-        meta_data['latitude'] = latitude
-        meta_data['longitude'] = longitude
-        meta_data.pop('GPS GPSLatitudeRef')
-        meta_data.pop('GPS GPSLatitude')
-        meta_data.pop('GPS GPSLongitudeRef')
-        meta_data.pop('GPS GPSLongitude')
-
-    set_image_date_str(meta_data, hashed_path)
-    if not 'latitude' in meta_data:
-        timestamp = datetime.strptime(meta_data['date'], '%Y%m%d_%H%M%S').timestamp()
-        latitude, longitude = location_ops.get_gpx_location(timestamp, max_diff)
-        if latitude and longitude:
-            meta_data['latitude'] = latitude
-            meta_data['longitude'] = longitude
-    return basename, sha512, meta_data
-
-
-def create_date_link(entry, dest_dir, db_meta):
+    extension = os.path.splitext(source)[1]
+
+    header = None
+    strategy = 'already stored'
+    if sha512 is not None:
+        count('cache_hits', 1)
+    if sha512 is None and partial_match:
+        sha512 = match_partial(source, signature_size(signature), store, db_size)
+        if sha512 is not None:
+            strategy = 'partial match'
+            db_ops.defer(db_manifest, store.manifest_key(signature), sha512)
+    if sha512 is None or not store.exists(sha512):
+        strategies = resolve_placement(source, store.raw_dir, placement, move_file)
+        if strategies[0] == 'copy':
+            strategy = 'copy'
+            with timer('copy'):
+                sha512, header = ingest_file(source, store)
+        else:
+            with timer('hash'):
+                sha512, header = ingest_file(source, store, write=False)
+            if not store.exists(sha512):
+                with timer('copy'):
+                    strategy = place_file(source, store.path(sha512, create=True), strategies)
+        add_to_size_index(db_size, signature_size(signature), sha512)
+        db_ops.defer(db_manifest, store.manifest_key(signature), sha512)
+
+    hashed_path = store.path(sha512)
+    hashed_path_extension = store.path_with_extension(sha512, extension, create=True)
+    if not os.path.exists(hashed_path_extension):
+        link_file(hashed_path, hashed_path_extension)
+
+    if full_rescan or not db_ops.get(db_meta, sha512):
+        with timer('exif'):
+            exif_fields = read_meta_fields(hashed_path, meta_tags, header)
+        db_ops.set(db_meta, sha512, build_meta_data(exif_fields, basename, hashed_path))
+        if db_exif:
+            load_full_exif(db_exif, store, sha512)
+    else:
+        count('skipped', 1)
+
+    if move_file:
+        remove_source(source, store.dest_dir)
+    return '{} ({})'.format(basename, strategy), source, sha512
+
+
+def get_meta_data(entry, store, db_meta, db_exif, full_rescan):
     source = entry[0]
     sha512 = entry[1]
 
     basename = os.path.basename(source)
-    extension = os.path.splitext(source)[1]
-    hashed_path = os.path.join(dest_dir, 'hashed/raw', sha512)
-    
-    date_str = db_ops.get(db_meta, sha512)['date']
-    index = 0
-    date_path = '{}_{:03}{}'.format(os.path.join(dest_dir, 'by_date', date_str), index, extension)
-    while os.path.exists(date_path):
-        if os.stat(date_path).st_ino == os.stat(hashed_path).st_ino:
-            break
-        index += 1
-        date_path = '{}_{:03}{}'.format(os.path.join(dest_dir, 'by_date', date_str), index, extension)
-    link_file(hashed_path, date_path)
-    date_basename = os.path.basename(date_path)
+    hashed_path = store.path(sha512)
+
+    if not full_rescan and db_ops.get(db_meta, sha512):
+        count('cache_hits', 1)
+        return '{} already parsed'.format(basename), None, None
+
+    if db_exif:
+        load_full_exif(db_exif, store, sha512)
+    with timer('exif'):
+        exif_fields = read_meta_fields(hashed_path, meta_tags)
+    return basename, sha512, build_meta_data(exif_fields, basename, hashed_path)
 
-    return basename, sha512, date_basename
-    
 
-def create_by_link(entry, dest_dir, db_meta, db_hash_datename):
+def build_meta_data(exif_fields, basename, hashed_path):
+    # the gpx location of files without exif location is looked up by resolve_locations
+    meta_data = MetaRecord(get_image_date(exif_fields, hashed_path), original_name=basename)
+    for by_tag in keyword_map:
+        setattr(meta_data, by_tag, search_tag(exif_fields, keyword_map[by_tag]))
+    if 'GPS GPSLatitudeRef' in exif_fields:
+        meta_data.latitude, meta_data.longitude = convert_exif_location_decimal(exif_fields)
+    return meta_data
+
+
+def as_record(meta_data):
+    '''
+    Returns meta data read from the store as MetaRecord, the exif dicts stored by older versions are converted.
+    '''
+    if not isinstance(meta_data, dict):
+        return meta_data
+    record = MetaRecord(parse_date(meta_data['date']) or 0, meta_data.get('latitude'), meta_data.get('longitude'), meta_data.get('original_name', ''),
+            location_key=meta_data.get('location_key'), location_path=meta_data.get('location_path'))
+    for by_tag in keyword_map:
+        setattr(record, by_tag, search_tag(meta_data, keyword_map[by_tag]))
+    return record
+
+
+def migrate_meta_data(db_meta, db_exif, chunk_size=1000):
+    '''
+    Converts the exif dicts stored in hash_meta by older versions to MetaRecords,
+    their exif tags are moved to hash_exif.
+    :return: number of converted entries
+    '''
+    converted = 0
+    for chunk in db_ops.iter_db_chunks(db_meta, chunk_size):
+        legacy = [ (sha512, meta_data) for sha512, meta_data in chunk if isinstance(meta_data, dict) ]
+        if not legacy:
+            continue
+        db_ops.set_many(db_exif, [ (sha512, { tag: value for tag, value in meta_data.items() if ' ' in tag }) for sha512, meta_data in legacy ])
+        db_ops.set_many(db_meta, [ (sha512, as_record(meta_data)) for sha512, meta_data in legacy ])
+        converted += len(legacy)
+    return converted
+
+
+def load_full_exif(db_exif, store, sha512):
+    '''
+    Returns all exif tags of a file, parsed from the stored file on first use.
+    '''
+    exif_data = db_ops.get(db_exif, sha512)
+    if exif_data is None:
+        with timer('exif'):
+            exif_data = read_full_exif(store.path(sha512))
+        db_ops.set(db_exif, sha512, exif_data)
+    return exif_data
+
+
+def resolve_locations(db_meta, db_location_cache, max_diff):
+    '''
+    Resolves the location path of all photos with location data in one process,
+    unknown places are reverse geocoded in batches and cached by their rounded coordinates.
+    Photos without exif location are located by the gpx index in one vectorized lookup.
+    The path is stored with the meta data, so the link stages only need to read the meta data.
+    :return: number of photos, number of photos located by gpx tracks and number of newly geocoded places
+    '''
+    pending = {}
+    unlocated = []
+    for sha512, meta_data in db_ops.iter_db(db_meta):
+        meta_data = as_record(meta_data)
+        if not meta_data:
+            continue
+        if not meta_data.has_location:
+            try:
+                unlocated.append((sha512, meta_data, datetime.strptime(str(meta_data.date), '%Y%m%d%H%M%S').timestamp()))
+            except ValueError:  # no valid date, e.g. 0000:00:00 00:00:00
+                pass
+            continue
+        key = location_ops.location_key(meta_data.latitude, meta_data.longitude)
+        if meta_data.location_key != key:
+            pending[sha512] = (key, meta_data)
+
+    latitudes, longitudes = location_ops.get_gpx_locations([ timestamp for _, _, timestamp in unlocated ], max_diff)
+    gpx_located = 0
+    for (sha512, meta_data, _), latitude, longitude in zip(unlocated, latitudes, longitudes):
+        if not math.isnan(latitude):
+            meta_data.latitude = float(latitude)
+            meta_data.longitude = float(longitude)
+            pending[sha512] = (location_ops.location_key(meta_data.latitude, meta_data.longitude), meta_data)
+            gpx_located += 1
+
+    keys = list(set( key for key, _ in pending.values() ))
+    paths = { key: path for key, path in zip(keys, db_ops.get_many(db_location_cache, keys)) if path is not None }
+    with timer('geocode'):
+        new_paths = location_ops.get_location_paths([ key for key in keys if key not in paths ])
+    db_ops.set_many(db_location_cache, new_paths.items())
+    paths.update(new_paths)
+
+    updates = []
+    for sha512, (key, meta_data) in pending.items():
+        meta_data.location_key = key
+        meta_data.location_path = paths[key]
+        updates.append((sha512, meta_data))
+        if len(updates) >= 1000:
+            db_ops.set_many(db_meta, updates)
+            updates = []
+    db_ops.set_many(db_meta, updates)
+    return len(pending), gpx_located, len(new_paths)
+
+
+def detect_faces(entry, store, db_hash_face, face_params, full_rescan):
     source = entry[0]
     sha512 = entry[1]
 
     basename = os.path.basename(source)
-    extension = os.path.splitext(source)[1]
-    hashed_path = os.path.join(dest_dir, 'hashed/raw', sha512)
+    cached = db_ops.get(db_hash_face, sha512)
+    # lists are full resolution results of older versions
+    if not full_rescan and (isinstance(cached, list) or (isinstance(cached, dict) and cached['params'] == face_params)):
+        count('cache_hits', 1)
+        return '{} already detected'.format(basename), None, None
+
+    import face_ops  # face_recognition is only needed with faces
+    with timer('face'):
+        summary = face_ops.detect_faces(store.path(sha512), face_params)
+    if len(summary) >= 1:
+        return '[37;1m{} has {} faces[0m'.format(basename, len(summary)), sha512, {'params': face_params, 'faces': summary}
+    return '{} has no faces'.format(basename), sha512, {'params': face_params, 'faces': summary}
 
-    meta_data = db_ops.get(db_meta, sha512)
-    date_basename = db_ops.get(db_hash_datename, sha512)
 
+def hash_image(entry, store, db_hash_phash, full_rescan):
+    source, sha512 = entry
+    basename = os.path.basename(source)
+    cached = db_ops.get(db_hash_phash, sha512)
+    if not full_rescan and cached is not None and cached['version'] == phash_ops.phash_version:
+        count('cache_hits', 1)
+        return '{} already hashed'.format(basename), None, None
+    with timer('image_hash'):
+        hashes = phash_ops.image_hashes(store.path(sha512))
+    if hashes is None:
+        return '{} has no image hash'.format(basename), sha512, {'version': phash_ops.phash_version, 'hashes': None}
+    return '{} hashed {:016x}'.format(basename, hashes[0]), sha512, {'version': phash_ops.phash_version, 'hashes': hashes}
+
+
+def plan_links(store, db_meta, db_hash_datename, db_hash_face, stages, persons={}, near_groups={}, chunk_size=1000):
+    '''
+    Computes the complete desired link tree from the store by running the given link stages
+    (see link_stages and link_stage_order) for every file stored in store, not only the ones found by this run,
+    the store is read in bulk per chunk of files. The database may be shared by several destinations,
+    files stored at other destinations are left out.
+    New by_date names are numbered by an atomic counter per date in the store, assigned once and stored.
+    persons maps sha512s to the person clusters on them (see person_ops.load_person_clusters),
+    near_groups sha512s to the name of their near duplicate group (see phash_ops.name_groups).
+    :return: dict of link path -> symlink content, both relative to the destination
+    '''
+    links = {}
+    known_max = {}
+    deferred = {}
+    for chunk in db_ops.iter_db_chunks(db_meta, chunk_size):
+        chunk = [ (sha512, as_record(meta_data)) for sha512, meta_data in chunk if meta_data and store.exists(sha512) ]
+        sha512s = [ sha512 for sha512, _ in chunk ]
+        date_basenames = db_ops.get_many(db_hash_datename, sha512s)
+        faces = db_ops.get_many(db_hash_face, sha512s) if 'faces' in stages else [None] * len(chunk)
+        for (sha512, meta_data), date_basename, summary in zip(chunk, date_basenames, faces):
+            context = {
+                    'sha512': sha512,
+                    'extension': os.path.splitext(meta_data.original_name)[1],
+                    'hashed_path': store.raw_path(sha512),
+                    'meta_data': meta_data,
+                    'date_basename': date_basename,
+                    'faces': summary,
+                    'persons': persons.get(sha512, ()),
+                    'near_group': near_groups.get(sha512),
+                    'links': links }
+            if date_basename:
+                date_str, index = split_date_basename(date_basename)
+                known_max[date_str] = max(index, known_max.get(date_str, -1))
+                run_link_stages(context, stages)
+            else:
+                deferred.setdefault(meta_data.date_str, []).append(context)
+
+    new_names = []
+    for date_str, contexts in deferred.items():
+        index = reserve_date_indices(db_hash_datename, date_str, len(contexts), known_max.get(date_str, -1))
+        for context in contexts:
+            context['date_basename'] = '{}_{:03}{}'.format(date_str, index, context['extension'])
+            index += 1
+            run_link_stages(context, stages)
+            new_names.append((context['sha512'], context['date_basename']))
+    for i in range(0, len(new_names), chunk_size):
+        db_ops.set_many(db_hash_datename, new_names[i:i+chunk_size])
+    return links
+
+
+def reserve_date_indices(db_hash_datename, date_str, amount, known_max):
+    key = 'next:' + date_str
+    # names assigned before the counter existed are numbered up to known_max
+    db_ops.seed_counter(db_hash_datename, key, known_max + 1)
+    first = db_ops.reserve(db_hash_datename, key, amount)
+    if first <= known_max:  # counter created by another destination sharing the store, reserve the missing numbers
+        db_ops.reserve(db_hash_datename, key, known_max + 1 - first)
+        first = known_max + 1
+    return first
+
+
+def run_link_stages(context, stages):
+    for stage in stages:
+        link_stages[stage][0](context)
+
+
+def add_link(context, path):
+    context['links'][path] = link_target(path, context['hashed_path'])
+
+
+def link_date(context):
+    add_link(context, 'by_date/' + context['date_basename'])
+
+
+def link_by(context):
     for by_tag in keyword_map:
-        value = search_tag(meta_data, keyword_map[by_tag])
-        value = re.sub('[^0-9A-Za-z]', '_', value)
-        path = os.path.join(dest_dir, by_tag, value)
-        os.makedirs(path, exist_ok=True)
-        path = os.path.join(path, date_basename)
-        link_file(hashed_path, path)
+        value = re.sub('[^0-9A-Za-z]', '_', getattr(context['meta_data'], by_tag))
+        add_link(context, '/'.join([by_tag, value, context['date_basename']]))
 
-    return basename, None, None
 
+def link_location(context):
+    meta_data = context['meta_data']; date_basename = context['date_basename']
 
-def create_by_location(entry, dest_dir, db_meta, db_hash_datename):
-    source = entry[0]
-    sha512 = entry[1]
+    if not meta_data.has_location:
+        add_link(context, 'by_location/_unknown_/' + date_basename)
+        return
 
-    basename = os.path.basename(source)
-    extension = os.path.splitext(source)[1]
-    hashed_path = os.path.join(dest_dir, 'hashed/raw', sha512)
-
-    meta_data = db_ops.get(db_meta, sha512)
-    date_basename = db_ops.get(db_hash_datename, sha512)
-
-    if 'latitude' not in meta_data:
-        path = os.path.join(dest_dir, 'by_location', '_unknown_', date_basename)
-        link_file(hashed_path, path)
-        return '{} has no location data'.format(basename), None, None
-
-    location_info = location_ops.get_location_info(meta_data['latitude'], meta_data['longitude'])['path']
-    location_info.reverse()
-    path = os.path.join(dest_dir, 'by_location')
-    while len(location_info) > 1:
-        path = os.path.join(path, location_info.pop())
-        dest_path = os.path.join(path, '_all_')
-        os.makedirs(dest_path, exist_ok=True)
-        dest_path = os.path.join(dest_path, date_basename)
-        link_file(hashed_path, dest_path)
-    path = os.path.join(path, location_info.pop())
-    os.makedirs(path, exist_ok=True)
-    path = os.path.join(path, date_basename)
-    link_file(hashed_path, path)
-
-    return '[37;1m{} has location data[0m'.format(basename), None, None
-
-
-def detect_faces(entry, dest_dir, db_hash_face, db_hash_datename):
-    source = entry[0]
-    sha512 = entry[1]
+    location_info = meta_data.location_path
+    if location_info is None:
+        location_info = location_ops.get_location_info(meta_data.latitude, meta_data.longitude)['path']
+    path = 'by_location'
+    for part in location_info[:-1]:
+        path += '/' + part
+        add_link(context, path + '/_all_/' + date_basename)
+    add_link(context, path + '/' + location_info[-1] + '/' + date_basename)
 
-    basename = os.path.basename(source)
-    hashed_path = os.path.join(dest_dir, 'hashed/raw', sha512)
-    date_basename = db_ops.get(db_hash_datename, sha512)
 
-    summary = db_ops.get(db_hash_face, sha512)
-    if not isinstance(summary, list):
-        summary = face_ops.detect_faces(source)
+def load_faces(context):
+    if isinstance(context['faces'], dict):
+        context['faces'] = context['faces']['faces']
+    elif not isinstance(context['faces'], list):  # not detected (yet)
+        context['faces'] = []
 
-    ret_str = ''
-    if len(summary) >= 1:
-        path = os.path.join(dest_dir, 'by_person', '_all_', date_basename)
-        link_file(hashed_path, path)
-        ret_str = '[37;1m{} has {} faces[0m'.format(basename, len(summary))
-    else:
-        ret_str = '{} has no faces'.format(basename)
 
-    return ret_str, sha512, summary
+def link_person(context):
+    if len(context['faces']) >= 1:
+        add_link(context, 'by_person/_all_/' + context['date_basename'])
+    for cluster in context['persons']:
+        add_link(context, 'by_person/{}/{}'.format(cluster, context['date_basename']))
+
+
+def link_near_duplicate(context):
+    if context['near_group']:
+        add_link(context, 'near_duplicates/{}/{}'.format(context['near_group'], context['date_basename']))
+
+
+# per file stages run by plan_links: name -> (function, stages it depends on)
+link_stages = {
+        'date': (link_date, []),
+        'by': (link_by, ['date']),
+        'location': (link_location, ['date']),
+        'faces': (load_faces, []),
+        'person': (link_person, ['date', 'faces']),
+        'near_duplicates': (link_near_duplicate, ['date']),
+        }
+
+
+def link_stage_order(stages):
+    '''
+    Returns the given link stages and all stages they depend on in an order satisfying the dependencies.
+    '''
+    order = []
+    def visit(stage):
+        if stage in order:
+            return
+        for dependency in link_stages[stage][1]:
+            visit(dependency)
+        order.append(stage)
+    for stage in stages:
+        visit(stage)
+    return order
 
 
 
@@ -186,6 +490,23 @@ def detect_faces(entry, dest_dir, db_hash_face, db_hash_datename):
 ################################################################################
 
 
+def remove_source(source, dest_dir):
+    if dest_dir == source[0:len(dest_dir)]:  # don't remove from destination directory
+        return
+    if os.path.lexists(source):  # already gone if it was placed by rename
+        os.remove(source)
+    try:
+        os.rmdir(os.path.split(source)[0])
+    except OSError:
+        pass
+
+
+def split_date_basename(date_basename):
+    # <date>_<index>.<extension> -> (<date>, <index>)
+    date_str, index = re.match(r'(.*)_(\d+)', date_basename).groups()
+    return date_str, int(index)
+
+
 def search_tag(meta_data, tags):
     for tag in tags:
         if tag in meta_data:
@@ -193,17 +514,9 @@ def search_tag(meta_data, tags):
     return '_unknown_'
 
 
-def set_image_date_str(meta_data, source):
-    if 'date' in meta_data:
-        return
+def get_image_date(exif_fields, source):
+    # exif date as YYYYmmddHHMMSS integer, fallback to the modification date
     for date_key in ['Image DateTimeOriginal', 'Image DateTime', 'EXIF DateTimeDigitized']:
-        if date_key in meta_data:
-            date_str = meta_data[date_key]
-            break
-    try:
-        date_str
-    except NameError:
-        date_str = datetime.fromtimestamp(os.stat(source).st_mtime)
-        date_str = date_str.strftime('%Y%m%d_%H%M%S')
-    date_str = str(date_str).replace(':','').replace(' ','_')
-    meta_data['date'] = date_str
+        if date_key in exif_fields and parse_date(exif_fields[date_key]) is not None:
+            return parse_date(exif_fields[date_key])
+    return int(datetime.fromtimestamp(os.stat(source).st_mtime).strftime('%Y%m%d%H%M%S'))
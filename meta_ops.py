@@ -0,0 +1,72 @@
+import math
+import re
+import struct
+
+# version byte of the packed records, pickled values start with 0x80
+record_version = 1
+record_header = struct.Struct('<BQdd')
+
+
+class MetaRecord:
+    '''
+    Fixed schema meta data of one file, the only fields used to sort it.
+    Stored packed (about 100 bytes) instead of the pickled exif dict,
+    the full exif data is kept separately in the hash_exif namespace if requested.
+    '''
+    __slots__ = ('date', 'latitude', 'longitude', 'original_name', 'by_camera_model', 'by_author', 'location_key', 'location_path')
+    strings = ('original_name', 'by_camera_model', 'by_author', 'location_key')
+
+    def __init__(self, date, latitude=None, longitude=None, original_name='', by_camera_model='_unknown_', by_author='_unknown_',
+            location_key=None, location_path=None):
+        self.date = date  # YYYYmmddHHMMSS as integer
+        self.latitude = latitude
+        self.longitude = longitude
+        self.original_name = original_name
+        self.by_camera_model = by_camera_model
+        self.by_author = by_author
+        self.location_key = location_key
+        self.location_path = location_path
+
+    @property
+    def date_str(self):
+        return '{:08}_{:06}'.format(self.date // 1000000, self.date % 1000000)
+
+    @property
+    def has_location(self):
+        return self.latitude is not None and self.longitude is not None
+
+    def pack(self):
+        latitude = self.latitude if self.has_location else math.nan
+        longitude = self.longitude if self.has_location else math.nan
+        strings = [ getattr(self, name) or '' for name in self.strings ]
+        strings.append('\x1f'.join(self.location_path) if self.location_path is not None else '\x1e')
+        return record_header.pack(record_version, self.date, latitude, longitude) + '\x00'.join(strings).encode('UTF-8')
+
+    @classmethod
+    def unpack(cls, value):
+        _, date, latitude, longitude = record_header.unpack_from(value)
+        original_name, by_camera_model, by_author, location_key, location_path = value[record_header.size:].decode('UTF-8').split('\x00')
+        return cls(date, None if math.isnan(latitude) else latitude, None if math.isnan(longitude) else longitude,
+                original_name, by_camera_model, by_author, location_key or None,
+                location_path.split('\x1f') if location_path != '\x1e' else None)
+
+    def __eq__(self, other):
+        return isinstance(other, MetaRecord) and all( getattr(self, name) == getattr(other, name) for name in self.__slots__ )
+
+    def __repr__(self):
+        return 'MetaRecord({})'.format(', '.join( '{}={!r}'.format(name, getattr(self, name)) for name in self.__slots__ ))
+
+
+def is_record(value):
+    return value[:1] == bytes([record_version])
+
+
+def parse_date(date_str):
+    '''
+    Converts a date string like 20190101_120000 (or an exif date 2019:01:01 12:00:00) to the numeric record date.
+    :return: the date as integer YYYYmmddHHMMSS or None if it is no valid date
+    '''
+    digits = re.sub(r'\D', '', str(date_str))
+    if len(digits) < 14:
+        return None
+    return int(digits[:14])
@@ -1,48 +1,334 @@
-import multiprocessing, traceback, sys, os, pickle
+import multiprocessing, queue, traceback, os, time, cProfile
+import db_ops
 from basic_ops import *
+from report_ops import counter_deltas, merge_profile_stats, latency_percentiles, format_metrics, max_rss
 
+# adaptive chunks are sized to take about this long per worker
+chunk_target_time = 0.5
+chunk_size_max = 1000
+# seconds between two renderings of the progress line
+progress_interval = 0.25
+# seconds the main process waits for results before it looks for dead workers
+poll_interval = 1
+# attempts to handle an entry before it is quarantined, also the number of workers an entry may kill
+entry_attempts = 3
 
-def handler(handler_function, handler_queue, extra_args, progress_max, progress_current, db):
-    process_id = multiprocessing.current_process().name
+
+def journal_key(stage, entry):
+    # the entries of all stages start with the source path
+    return '{}:{}'.format(stage, entry[0])
+
+
+def handle_chunk(entries, stage, handler_function, db, extra_args, profile, journal, wait=0):
+    '''
+    Handles the entries of one chunk of a stage and writes their results in one batch,
+    the writes deferred by the handler (see db_ops.defer) are returned with the timing.
+    :return: number of entries, elapsed time, last log output, counters and timing of the chunk
+    '''
+    start = time.perf_counter()
+    cpu_start = time.process_time()
+    profiler = cProfile.Profile() if profile else None
+    if profiler:
+        profiler.enable()
+    log_output = ''
+    write_buffer = []
+    latencies = []
+    done = []
+    failed = []
+    for entry in entries:
+        entry_start = time.perf_counter()
+        for attempt in range(entry_attempts):
+            try:
+                log_output, k, v = handler_function(entry, *extra_args)
+                if k and db:
+                    write_buffer.append((k, v))
+                done.append(entry)
+                break
+            except Exception as e:
+                error = '{}: {}'.format(type(e).__name__, e)
+                error_traceback = traceback.format_exc()
+        else:
+            failed.append({'entry': entry, 'error': error, 'traceback': error_traceback, 'attempts': entry_attempts})
+            log_output = 'failed to handle {}: {}'.format(entry[0], error)
+        latencies.append(time.perf_counter() - entry_start)
+    if write_buffer:
+        db_ops.set_many(db, write_buffer)
+    deferred = db_ops.take_deferred()
+    # the results are written before the entries are journaled, an interrupted chunk is handled again
+    if journal is not None and done:
+        db_ops.set_many(journal, [ (journal_key(stage, entry), None) for entry in done ])
+    profile_stats = None
+    if profiler:
+        profiler.disable()
+        profiler.create_stats()
+        profile_stats = profiler.stats
+    timing = {'worker': os.getpid(), 'wait': wait, 'cpu': time.process_time() - cpu_start, 'max_rss': max_rss(),
+            'latencies': latencies, 'profile': profile_stats, 'failed': failed, 'deferred': deferred}
+    chunk_counters = dict(counters)
+    for name in counter_names:
+        counters[name] = 0
+    return len(entries), time.perf_counter() - start, log_output, chunk_counters, timing
+
+
+def worker(task_queue, result_queue, slot, initializer, initargs):
+    if initializer:
+        initializer(*initargs)
+    for name in counter_names:
+        counters[name] = 0
+    last_handler = None
     while True:
-        entry = handler_queue.get()
+        wait_start = time.perf_counter()
+        task = task_queue.get()
+        if task is None:
+            return
+        chunk_id = task[0]
+        # the main process requeues this chunk if the worker dies
+        slot.value = chunk_id
+        # waiting for the first chunk of a stage is idle time between the stages, not queue wait
+        wait = time.perf_counter() - wait_start if task[3] == last_handler else 0
+        last_handler = task[3]
+        result_queue.put((chunk_id,) + handle_chunk(*task[1:], wait=wait))
+        slot.value = -1
+
+
+class WorkerPool:
+    '''
+    Long-lived worker processes used for all stages of a run.
+    Entries are dispatched in chunks, each worker writes the results of a chunk in one batch,
+    the writes deferred by the handlers are applied by the main process when the result of the chunk arrives.
+    The initializer is called once per worker to load expensive state.
+    The metrics of every stage are added to report (see report_ops.RunReport).
+
+    Entries failing entry_attempts times are recorded with their error in quarantine instead of stopping the run.
+    Dead workers are respawned, the chunk they worked on is requeued entry by entry,
+    so an entry killing entry_attempts workers is quarantined as well.
+    Every handled entry is recorded per stage in journal, with resume the entries recorded by an interrupted run are skipped.
+    '''
+    def __init__(self, num_threads=8, size_queue=10, chunk_size=0, initializer=None, initargs=(), report=None,
+            journal=None, resume=False, quarantine=None):
+        self.chunk_size = chunk_size
+        self.initializer = initializer
+        self.initargs = initargs
+        self.report = report
+        self.journal = journal
+        self.resume = resume
+        self.quarantine = quarantine
+        self.next_chunk_id = 0
+        self.start_workers(num_threads, size_queue)
+
+    def start_workers(self, num_threads, size_queue):
+        self.task_queue = multiprocessing.Queue(size_queue)
+        self.result_queue = multiprocessing.Queue()
+        self.processes = []
+        self.slots = []
+        for i in range(0, num_threads):
+            process, slot = self.spawn(i)
+            self.processes.append(process)
+            self.slots.append(slot)
+
+    def spawn(self, i):
+        slot = multiprocessing.Value('q', -1, lock=False)
+        process = multiprocessing.Process(name = '{}'.format(i), target=worker,
+                args=(self.task_queue, self.result_queue, slot, self.initializer, self.initargs))
+        process.start()
+        return process, slot
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *args):
+        self.close(terminate = exc_type is not None)
+
+    def close(self, terminate=False):
+        '''
+        Stops the workers after their current chunk, with terminate (the run failed) they are killed right away.
+        '''
+        if terminate:
+            self.task_queue.cancel_join_thread()
+            for process in self.processes:
+                process.terminate()
+        else:
+            for process in self.processes:
+                self.task_queue.put(None)
+        for process in self.processes:
+            process.join()
+
+    def run(self, iter_function, handler_function, db=None, handler_args=(), iter_args=(), progress_max=None, name=None):
+        '''
+        Handles all entries yielded by iter_function with handler_function in the workers.
+        The stage is named after the handler unless name is given.
+        :return: the summed up counters of all workers
+        '''
+        name = name or handler_function.__name__
+        profile = self.report is not None and self.report.profile_stage == name
+        self.stage = (name, handler_function, db, handler_args, profile, self.journal)
+        self.progress_max = progress_max
+        self.start = time.perf_counter()
+        cpu_start = time.process_time()
+        main_counters = dict(counters)
+        self.in_flight = {}
+        self.requeued = []
+        self.progress_current = 0
+        self.item_time = None
+        self.totals = dict.fromkeys(counter_names, 0)
+        self.workers = {}
+        self.latencies = []
+        self.profile_stats = {}
+        self.rendered = 0
+        self.checked = time.perf_counter()
+        self.log_output = ''
+        self.blocked = 0
+        chunk_size = self.chunk_size or 1
+        chunk = []
+        for entry in iter_function(*iter_args):
+            chunk.append(entry)
+            if len(chunk) >= chunk_size:
+                self.dispatch(self.pending_entries(chunk))
+                chunk = []
+                while self.results_waiting():
+                    self.collect(progress_max)
+                if not self.chunk_size and self.item_time:
+                    chunk_size = max(1, min(chunk_size_max, int(chunk_target_time / self.item_time)))
+        if chunk:
+            self.dispatch(self.pending_entries(chunk))
+        produced = time.perf_counter() - self.start
+        while self.in_flight or self.requeued:
+            self.collect(progress_max)
+        self.render(progress_max)
+        print('\n')
+
+        for counter_name, value in counter_deltas(main_counters).items():
+            self.totals[counter_name] += value
+        metrics = self.stage_metrics(name, time.perf_counter() - self.start, time.process_time() - cpu_start, produced, self.blocked)
+        print(format_metrics(metrics))
+        if self.report is not None:
+            self.report.add(metrics)
+            if profile:
+                self.report.add_profile(name, self.profile_stats)
+        return self.totals
+
+    def pending_entries(self, entries):
+        '''
+        Drops the entries an interrupted run already handled in this stage.
+        '''
+        if not self.resume or self.journal is None:
+            return entries
+        done = db_ops.exists_many(self.journal, [ journal_key(self.stage[0], entry) for entry in entries ])
+        pending = [ entry for entry, entry_done in zip(entries, done) if not entry_done ]
+        self.progress_current += len(entries) - len(pending)
+        self.totals['resumed'] += len(entries) - len(pending)
+        return pending
+
+    def dispatch(self, entries, deaths=0):
+        if not entries:
+            return
+        chunk_id = self.next_chunk_id
+        self.next_chunk_id += 1
+        self.in_flight[chunk_id] = (entries, deaths)
+        put_start = time.perf_counter()
+        self.send(chunk_id, (chunk_id, entries) + self.stage)
+        self.blocked += time.perf_counter() - put_start
+
+    def send(self, chunk_id, task):
+        while True:
+            try:
+                self.task_queue.put(task, timeout=poll_interval)
+                return
+            except queue.Full:  # all workers busy or dead
+                self.check_workers()
+
+    def receive(self):
         try:
-            log_output, k, v = handler_function(entry, *extra_args)
-            if k and db:
-                if v != None:
-                    db.set(k, pickle.dumps(v))
-                else:
-                    db.append(k, b'')
-        except Exception:
-            print('Failed to handle {}'.format(entry))
-            traceback.print_exc(file=sys.stdout)
-            os._exit(10)
+            return self.result_queue.get(timeout=poll_interval)
+        except queue.Empty:
+            return None
+
+    def results_waiting(self):
+        return not self.result_queue.empty()
+
+    def check_workers(self):
+        '''
+        Respawns dead workers and requeues the chunks they died on entry by entry,
+        an entry which killed entry_attempts workers is quarantined.
+        '''
+        self.checked = time.perf_counter()
+        for i, process in enumerate(self.processes):
+            if process.is_alive():
+                continue
+            chunk_id = self.slots[i].value
+            print('\nworker {} died with exit code {}, respawning it'.format(process.pid, process.exitcode))
+            self.processes[i], self.slots[i] = self.spawn(i)
+            if chunk_id not in self.in_flight:
+                continue
+            entries, deaths = self.in_flight.pop(chunk_id)
+            if len(entries) == 1 and deaths + 1 >= entry_attempts:
+                self.quarantine_entries([{'entry': entries[0], 'error': 'worker died with exit code {}'.format(process.exitcode),
+                    'traceback': '', 'attempts': deaths + 1}])
+                self.progress_current += 1
+            else:
+                self.requeued += [ ([entry], deaths + 1) for entry in entries ]
+
+    def quarantine_entries(self, failed):
+        stage = self.stage[0]
+        for failure in failed:
+            print('\n{} quarantined {}: {}'.format(stage, failure['entry'][0], failure['error']))
+        self.totals['quarantined'] += len(failed)
+        if self.quarantine is not None:
+            failed_at = time.strftime('%Y-%m-%dT%H:%M:%S')
+            db_ops.set_many(self.quarantine, [ (journal_key(stage, failure['entry']), dict(failure, stage=stage, failed_at=failed_at)) for failure in failed ])
+
+    def collect(self, progress_max):
+        while self.requeued:
+            self.dispatch(*self.requeued.pop())
+        if time.perf_counter() - self.checked >= poll_interval:
+            self.check_workers()
+        result = self.receive()
+        if result is None:
+            self.check_workers()
+            return
+        chunk_id, num_entries, elapsed, log_output, worker_counters, timing = result
+        if self.in_flight.pop(chunk_id, None) is None:  # requeued, its worker died after sending the result
+            return
+        self.progress_current += num_entries
+        item_time = elapsed / num_entries
+        self.item_time = item_time if self.item_time is None else 0.8 * self.item_time + 0.2 * item_time
+        for name in counter_names:
+            self.totals[name] += worker_counters[name]
+        worker = self.workers.setdefault(timing['worker'], {'worker': timing['worker'], 'items': 0, 'work': 0, 'wait': 0, 'cpu': 0, 'max_rss': 0})
+        worker['items'] += num_entries
+        worker['work'] += elapsed
+        worker['wait'] += timing['wait']
+        worker['cpu'] += timing['cpu']
+        worker['max_rss'] = max(worker['max_rss'], timing['max_rss'])
+        self.latencies += timing['latencies']
+        if timing['profile']:
+            merge_profile_stats(self.profile_stats, timing['profile'])
+        if timing['failed']:
+            self.quarantine_entries(timing['failed'])
+        db_ops.apply_deferred(timing['deferred'])
+        self.log_output = log_output
+        if time.perf_counter() - self.rendered >= progress_interval:
+            self.render(progress_max)
+
+    def render(self, progress_max):
+        # the progress line is only rendered every progress_interval, not for every chunk
+        self.rendered = time.perf_counter()
+        rate = self.progress_current / max(self.rendered - self.start, 1e-9)
         if progress_max:
-            progress_current.value += 1
-            stdout('{:6.2f}% Process {}: {}'.format(progress_current.value/progress_max, process_id, log_output))
+            stdout('{:6.2f}% {:.0f} files/s | {}'.format(100 * self.progress_current / progress_max, rate, self.log_output))
         else:
-            stdout('Process {}: {}'.format(process_id, log_output))
-        handler_queue.task_done()
-
-
-def iter_threaded(iter_funtion, handler_function, db=None, handler_args=(), num_threads=8, size_queue=10, iter_args=(), progress_max=None):
-    processes = []
-    progress_current = None
-    if progress_max:
-        progress_max /= 100
-        progress_current = multiprocessing.Value('i', 0)
-    handler_queue = multiprocessing.JoinableQueue(size_queue)
-    for i in range(0, num_threads):
-        process = multiprocessing.Process(name = '{}'.format(i), target=handler, args=(handler_function, handler_queue, handler_args, progress_max, progress_current, db))
-        process.start()
-        processes.append(process)
-    for request in iter_funtion(*iter_args):
-        handler_queue.put(request)
-    handler_queue.join()
-    handler_queue.close()
-    for process in processes:
-        process.terminate()
-        process.join()
-    if progress_max:
-        sys.stdout.write('\r100.00%')
-    print('\n')
+            stdout('{} files {:.0f} files/s | {}'.format(self.progress_current, rate, self.log_output))
+
+    def stage_metrics(self, name, wall_time, cpu_time, produced, blocked):
+        '''
+        :param produced: time until the last entry was queued, blocked: time the producer waited for a free slot in the queue
+        '''
+        workers = sorted(self.workers.values(), key=lambda worker: worker['worker'])
+        bytes_moved = self.totals['bytes_read'] + self.totals['bytes_written']
+        return {'stage': name, 'items': self.progress_current, 'wall_time': wall_time,
+                'cpu_time': cpu_time + sum( worker['cpu'] for worker in workers ), 'main_cpu_time': cpu_time,
+                'items_per_s': self.progress_current / max(wall_time, 1e-9), 'bytes_per_s': bytes_moved / max(wall_time, 1e-9),
+                'producer_time': produced, 'producer_blocked': blocked,
+                'max_rss': max([max_rss()] + [ worker['max_rss'] for worker in workers ]),
+                'latency': latency_percentiles(self.latencies), 'workers': workers,
+                'counters': { counter_name: value for counter_name, value in self.totals.items() if value }}
@@ -0,0 +1,171 @@
+import os
+import json
+import numpy
+import db_ops
+from basic_ops import atomic_write
+
+# side table of the face index, one row per face, the encodings are kept in encodings.f32
+face_dtype = numpy.dtype([('sha512', 'u1', (64,)), ('top', '<i4'), ('right', '<i4'), ('bottom', '<i4'), ('left', '<i4'), ('cluster', '<i4')])
+encoding_size = 128
+
+# maximum distance of a face to the centroid of its cluster (face_recognition compares faces with 0.6)
+cluster_tolerance = 0.5
+block_size = 4096
+# clusters with fewer faces get no by_person/<cluster> directory
+min_cluster_size = 2
+
+
+def index_paths(index_dir):
+    return {name: os.path.join(index_dir, name) for name in ['index.json', 'encodings.f32', 'faces.bin']}
+
+
+def clusters_name(count):
+    # the centroids and sizes of the clusters after count faces, named in index.json
+    return 'clusters_{}.npz'.format(count)
+
+
+def open_face_index(index_dir, params):
+    '''
+    Maps the face index read only: encodings (n x 128 float32), side table (face_dtype), centroids and sizes of the clusters.
+    index.json is written last and names the clusters file matching its count, so an interrupted update leaves the
+    previous index: the rows it appended are dropped. The index is reset if it was built with other detector params.
+    '''
+    paths = index_paths(index_dir)
+    info = {'params': params, 'count': 0}
+    if os.path.exists(paths['index.json']):
+        with open(paths['index.json']) as f:
+            info = json.load(f)
+    if info['params'] != params or 'clusters' not in info:  # clusters are missing in indexes of older versions
+        info = {'params': params, 'count': 0}
+    count = info['count']
+    os.makedirs(index_dir, exist_ok=True)
+    for name, row_size in [('encodings.f32', 4 * encoding_size), ('faces.bin', face_dtype.itemsize)]:
+        with open(paths[name], 'ab') as f:
+            f.truncate(count * row_size)
+    if count:
+        encodings = numpy.memmap(paths['encodings.f32'], dtype='<f4', mode='r', shape=(count, encoding_size))
+        faces = numpy.memmap(paths['faces.bin'], dtype=face_dtype, mode='r', shape=(count,))
+        with numpy.load(os.path.join(index_dir, info['clusters'])) as clusters:
+            centroids = clusters['centroids']
+            counts = clusters['counts']
+    else:
+        encodings = numpy.empty((0, encoding_size), dtype='<f4')
+        faces = numpy.empty(0, dtype=face_dtype)
+        centroids = numpy.empty((0, encoding_size), dtype='<f4')
+        counts = numpy.empty(0, dtype=numpy.int64)
+    return {'info': info, 'encodings': encodings, 'faces': faces, 'centroids': centroids, 'counts': counts}
+
+
+def nearest_centroids(encodings, centroids):
+    '''
+    Blocked squared distances |a|^2 + |c|^2 - 2ac as matrix products.
+    :return: index of and distance to the nearest centroid for every encoding
+    '''
+    nearest = numpy.full(len(encodings), -1)
+    distances = numpy.full(len(encodings), numpy.inf, dtype=numpy.float32)
+    if not len(centroids):
+        return nearest, distances
+    centroid_norms = numpy.einsum('ij,ij->i', centroids, centroids)
+    for i in range(0, len(encodings), block_size):
+        block = encodings[i:i+block_size]
+        squared = numpy.einsum('ij,ij->i', block, block)[:, None] + centroid_norms[None, :] - 2 * block @ centroids.T
+        nearest[i:i+block_size] = numpy.argmin(squared, axis=1)
+        distances[i:i+block_size] = numpy.sqrt(numpy.maximum(squared[numpy.arange(len(block)), nearest[i:i+block_size]], 0))
+    return nearest, distances
+
+
+def assign_clusters(encodings, centroids, counts):
+    '''
+    Incremental centroid clustering: every face joins the nearest cluster within cluster_tolerance,
+    the remaining faces of a block found new clusters around leaders, the centroids are updated per block.
+    Faces are only compared with the centroids, not with each other.
+    :return: cluster of every encoding, the new centroids and cluster sizes
+    '''
+    labels = numpy.empty(len(encodings), dtype=numpy.int32)
+    for i in range(0, len(encodings), block_size):
+        block = encodings[i:i+block_size]
+        nearest, distances = nearest_centroids(block, centroids)
+        assigned = distances <= cluster_tolerance
+        block_labels = numpy.where(assigned, nearest, -1)
+
+        # running means of the clusters joined by this block
+        sums = numpy.zeros_like(centroids)
+        numpy.add.at(sums, nearest[assigned], block[assigned])
+        joined = numpy.bincount(nearest[assigned], minlength=len(centroids))
+        grown = joined > 0
+        centroids[grown] = (centroids[grown] * counts[grown, None] + sums[grown]) / (counts[grown] + joined[grown])[:, None]
+        counts = counts + joined
+
+        rest = numpy.flatnonzero(~assigned)
+        new_centroids = []
+        new_counts = []
+        while len(rest):
+            leader_distances = numpy.linalg.norm(block[rest] - block[rest[0]], axis=1)
+            members = rest[leader_distances <= cluster_tolerance]
+            block_labels[members] = len(centroids) + len(new_centroids)
+            new_centroids.append(block[members].mean(axis=0))
+            new_counts.append(len(members))
+            rest = rest[leader_distances > cluster_tolerance]
+        if new_centroids:
+            centroids = numpy.concatenate([centroids, numpy.array(new_centroids, dtype=centroids.dtype)])
+            counts = numpy.concatenate([counts, new_counts])
+        labels[i:i+block_size] = block_labels
+    return labels, centroids, counts
+
+
+def update_face_index(index_dir, db_hash_face, params, store=None, chunk_size=1000):
+    '''
+    Appends the faces of all files (stored in store if given) detected with params (or by older versions) that are not indexed yet
+    and assigns them to the existing clusters, clusters are never recomputed from scratch.
+    :return: number of new faces and number of clusters
+    '''
+    index = open_face_index(index_dir, params)
+    indexed = set( sha512.tobytes() for sha512 in index['faces']['sha512'] )
+    encodings = []
+    faces = []
+    for chunk in db_ops.iter_db_chunks(db_hash_face, chunk_size):
+        for sha512, summary in chunk:
+            if isinstance(summary, dict):
+                if summary['params'] != params:
+                    continue
+                summary = summary['faces']
+            if not summary or bytes.fromhex(sha512) in indexed or (store is not None and not store.exists(sha512)):
+                continue
+            for face in summary:
+                encodings.append(face['encoding'])
+                faces.append((numpy.frombuffer(bytes.fromhex(sha512), dtype='u1'), face['top'], face['right'], face['bottom'], face['left'], -1))
+    if not faces:
+        return 0, len(index['centroids'])
+
+    encodings = numpy.array(encodings, dtype='<f4').reshape(-1, encoding_size)
+    faces = numpy.array(faces, dtype=face_dtype)
+    faces['cluster'], centroids, counts = assign_clusters(encodings, numpy.array(index['centroids']), index['counts'])
+
+    paths = index_paths(index_dir)
+    with open(paths['encodings.f32'], 'ab') as f:
+        f.write(encodings.tobytes())
+    with open(paths['faces.bin'], 'ab') as f:
+        f.write(faces.tobytes())
+    index['info']['count'] += len(faces)
+    index['info']['clusters'] = clusters_name(index['info']['count'])
+    with atomic_write(os.path.join(index_dir, index['info']['clusters']), 'wb') as f:
+        numpy.savez(f, centroids=centroids, counts=counts)
+    with atomic_write(paths['index.json']) as f:
+        json.dump(index['info'], f)
+    for name in os.listdir(index_dir):
+        if name.startswith('clusters_') and name != index['info']['clusters']:
+            os.remove(os.path.join(index_dir, name))
+    return len(faces), len(centroids)
+
+
+def load_person_clusters(index_dir, params):
+    '''
+    :return: dict of sha512 -> set of names of the clusters (with at least min_cluster_size faces) of the faces on it
+    '''
+    index = open_face_index(index_dir, params)
+    large = index['counts'] >= min_cluster_size
+    persons = {}
+    for face in index['faces']:
+        if large[face['cluster']]:
+            persons.setdefault(face['sha512'].tobytes().hex(), set()).add('{:06}'.format(face['cluster']))
+    return persons
@@ -0,0 +1,221 @@
+import io
+import os
+import json
+import itertools
+import numpy
+import db_ops
+from basic_ops import atomic_write
+from PIL import Image
+from exif_ops import read_header, read_thumbnail, read_preview
+
+# bump when the hashes change, cached hashes of other versions are computed again
+phash_version = 1
+# images with less contrast (black frames, blank pages) get no hash, they would all be near duplicates of each other
+min_contrast = 2.0
+# pixel value up to which rows and columns at the border count as black bars of a padded thumbnail
+bar_level = 16
+# substrings of 16 bits the multi-index is built of
+index_parts = 4
+block_size = 4096
+
+popcounts = numpy.array([ bin(i).count('1') for i in range(256) ], dtype=numpy.uint8)
+
+
+def dct_matrix(size):
+    k = numpy.arange(size)
+    matrix = numpy.cos(numpy.pi * (2 * k[None, :] + 1) * k[:, None] / (2 * size)) * numpy.sqrt(2 / size)
+    matrix[0] /= numpy.sqrt(2)
+    return matrix
+
+dct_32 = dct_matrix(32)
+
+
+def load_small_image(path, size=32):
+    '''
+    Decodes the exif thumbnail of path (the embedded preview of raw files, the image itself if there is none)
+    at the smallest JPEG scale (draft mode) of at least 2 * size pixels, black bars of padded thumbnails are cut off.
+    :return: grayscale PIL image
+    '''
+    header = read_header(path)
+    data = read_thumbnail(path, header) or read_preview(path, header)
+    image = Image.open(io.BytesIO(data) if data else path)
+    image.draft('L', (2 * size, 2 * size))
+    image = image.convert('L')
+    pixels = numpy.asarray(image)
+    rows = numpy.flatnonzero(pixels.max(axis=1) > bar_level)
+    columns = numpy.flatnonzero(pixels.max(axis=0) > bar_level)
+    if len(rows) and len(columns):
+        image = image.crop((columns[0], rows[0], columns[-1] + 1, rows[-1] + 1))
+    return image
+
+
+def pack_bits(bits):
+    return int.from_bytes(numpy.packbits(bits).tobytes(), 'big')
+
+
+def image_hashes(path):
+    '''
+    pHash (signs of the 8x8 lowest frequencies of the DCT of the 32x32 image against their median)
+    and dHash (signs of the horizontal gradients of the 9x8 image), both 64 bit.
+    :return: (phash, dhash) or None if the image has no contrast or can not be decoded
+    '''
+    try:
+        image = load_small_image(path)
+        pixels = numpy.asarray(image.resize((32, 32), Image.BOX), dtype=numpy.float64)
+        gradient_pixels = numpy.asarray(image.resize((9, 8), Image.BOX), dtype=numpy.float64)
+    except OSError:
+        return None
+    if pixels.std() < min_contrast:
+        return None
+    frequencies = (dct_32 @ pixels @ dct_32.T)[:8, :8].flatten()
+    phash = pack_bits(frequencies > numpy.median(frequencies[1:]))
+    dhash = pack_bits(gradient_pixels[:, 1:] > gradient_pixels[:, :-1])
+    return phash, dhash
+
+
+def hamming_distances(a, b):
+    return popcounts[(a ^ b).view(numpy.uint8)].reshape(-1, 8).sum(axis=1)
+
+
+class HammingIndex:
+    '''
+    Multi-index hashing of 64 bit hashes: every hash is split into index_parts substrings, each substring is kept sorted.
+    Two hashes within max_distance share at least one substring within max_distance // index_parts (pigeonhole),
+    so a query looks up these few substring values by binary search instead of comparing with all hashes.
+    '''
+    def __init__(self, hashes):
+        self.hashes = hashes
+        self.tables = []
+        for part in range(index_parts):
+            keys = self.part(hashes, part)
+            order = numpy.argsort(keys, kind='stable')
+            self.tables.append((keys[order], order))
+
+    @staticmethod
+    def part(hashes, part):
+        return ((hashes >> numpy.uint64(16 * part)) & numpy.uint64(0xffff)).astype(numpy.uint16)
+
+    @staticmethod
+    def flip_masks(radius):
+        return numpy.array([ sum( 1 << bit for bit in bits ) for distance in range(radius + 1)
+            for bits in itertools.combinations(range(16), distance) ], dtype=numpy.uint16)
+
+    def query(self, queries, max_distance):
+        '''
+        :return: arrays of the positions in queries and in the index of all pairs within max_distance
+        '''
+        masks = self.flip_masks(max_distance // index_parts)
+        candidates = []
+        for part, (keys, order) in enumerate(self.tables):
+            query_keys = self.part(queries, part)
+            for mask in masks:
+                lookup = query_keys ^ mask
+                low = numpy.searchsorted(keys, lookup, 'left')
+                high = numpy.searchsorted(keys, lookup, 'right')
+                sizes = high - low
+                total = sizes.sum()
+                if not total:
+                    continue
+                offsets = numpy.arange(total) - numpy.repeat(numpy.cumsum(sizes) - sizes, sizes)
+                matches = order[numpy.repeat(low, sizes) + offsets]
+                candidates.append(numpy.repeat(numpy.arange(len(queries), dtype=numpy.int64), sizes) * len(self.hashes) + matches)
+        if not candidates:
+            return numpy.empty(0, dtype=numpy.int64), numpy.empty(0, dtype=numpy.int64)
+        pairs = numpy.unique(numpy.concatenate(candidates))
+        query_positions, positions = pairs // len(self.hashes), pairs % len(self.hashes)
+        near = hamming_distances(queries[query_positions], self.hashes[positions]) <= max_distance
+        return query_positions[near], positions[near]
+
+
+def connected_components(size, first, second):
+    '''
+    :return: label of every node, the smallest node of its component
+    '''
+    labels = numpy.arange(size)
+    while True:
+        joined = numpy.minimum(labels[first], labels[second])
+        updated = labels.copy()
+        numpy.minimum.at(updated, first, joined)
+        numpy.minimum.at(updated, second, joined)
+        updated = updated[updated]
+        if numpy.array_equal(updated, labels):
+            return labels
+        labels = updated
+
+
+def find_near_duplicates(db_hash_phash, max_distance, store=None, chunk_size=1000):
+    '''
+    Groups all hashed files (stored in store if given) whose pHash and dHash are both within max_distance bits, transitively.
+    :return: list of groups, each a list of sha512s
+    '''
+    sha512s = []
+    hashes = []
+    for chunk in db_ops.iter_db_chunks(db_hash_phash, chunk_size):
+        for sha512, result in chunk:
+            if result and result['hashes'] and (store is None or store.exists(sha512)):
+                sha512s.append(sha512)
+                hashes.append(result['hashes'])
+    if not hashes:
+        return []
+    hashes = numpy.array(hashes, dtype=numpy.uint64).reshape(-1, 2)
+    phashes, dhashes = numpy.ascontiguousarray(hashes[:, 0]), numpy.ascontiguousarray(hashes[:, 1])
+
+    index = HammingIndex(phashes)
+    first = []
+    second = []
+    for i in range(0, len(phashes), block_size):
+        query_positions, positions = index.query(phashes[i:i+block_size], max_distance)
+        query_positions += i
+        near = (query_positions < positions) & (hamming_distances(dhashes[query_positions], dhashes[positions]) <= max_distance)
+        first.append(query_positions[near])
+        second.append(positions[near])
+    first = numpy.concatenate(first)
+    second = numpy.concatenate(second)
+    if not len(first):
+        return []
+
+    labels = connected_components(len(phashes), first, second)
+    grouped = numpy.unique(numpy.concatenate([first, second]))
+    groups = {}
+    for position in grouped:
+        groups.setdefault(labels[position], []).append(sha512s[position])
+    return list(groups.values())
+
+
+def name_groups(groups, store):
+    '''
+    Names every group by the first 16 characters of its largest file (most likely the original),
+    the name only changes if a larger file joins the group.
+    :return: dict of sha512 -> group name and list of groups with their largest file first
+    '''
+    names = {}
+    ordered = []
+    for group in groups:
+        sizes = { sha512: os.path.getsize(store.path(sha512)) if store.exists(sha512) else 0 for sha512 in group }
+        group = sorted(group, key=lambda sha512: (-sizes[sha512], sha512))
+        ordered.append((group[0][:16], [ (sha512, sizes[sha512]) for sha512 in group ]))
+        for sha512 in group:
+            names[sha512] = group[0][:16]
+    return names, ordered
+
+
+def write_report(path, groups, db_meta, db_hash_phash):
+    '''
+    Writes the near duplicate groups as json: per group the files with their original name, size and
+    pHash distance to the largest file of the group, largest groups first.
+    '''
+    report = []
+    for name, members in sorted(groups, key=lambda group: (-len(group[1]), group[0])):
+        sha512s = [ sha512 for sha512, _ in members ]
+        hashes = [ result['hashes'][0] for result in db_ops.get_many(db_hash_phash, sha512s) ]
+        distances = hamming_distances(numpy.array(hashes, dtype=numpy.uint64), numpy.uint64(hashes[0]))
+        files = []
+        for (sha512, size), meta_data, distance in zip(members, db_ops.get_many(db_meta, sha512s), distances):
+            if isinstance(meta_data, dict):  # not migrated meta data of older versions
+                original_name = meta_data.get('original_name')
+            else:
+                original_name = meta_data.original_name if meta_data else None
+            files.append({'sha512': sha512, 'original_name': original_name, 'size': size, 'distance': int(distance)})
+        report.append({'group': name, 'files': files})
+    with atomic_write(path) as f:
+        json.dump(report, f, indent=1)
@@ -1,9 +1,13 @@
 #!/usr/bin/env python3
 import argparse
-import db_ops, file_ops
+import db_ops, link_ops, location_ops, person_ops, phash_ops, queue_ops
 from main_ops import *
-from file_ops import iter_files
-from mt_ops import handler, iter_threaded
+from file_ops import placement_strategies, hash_algorithms
+from scan_ops import Scanner
+from content_ops import open_store
+from mt_ops import WorkerPool
+from queue_ops import LeaseQueue, QueuePool
+from report_ops import RunReport
 
 description='''
 Search pictures at given paths and sorts them based on there exif data.
@@ -11,37 +15,85 @@ Search pictures at given paths and sorts them based on there exif data.
 This script generates following structure at the destination directory:
     * hashed/raw/
         - all found files without an extension named by the sha512sum
+          (or the digest of --hash-algorithm), spread over sub directories by the
+          first characters of the sum (see --fan-out)
     * hashed/with_extension/
-        - links to hashed files with extension appended
+        - links to hashed files with extension appended, same sub directories
     * by_date/
         - links to hashed files with extension appended and named by exif date
           (fallback to modification date)
           The date is converted to UTC and named by the UTC time
 
 
-IMPORTANT: Do not delete the log.json file at the destination!!!
-           This file is required to update all links and keeps track of the
-           corrected extension and original path.
+All hashes, meta data and caches are kept in the store given by --store,
+either a redis server or an embedded sqlite database (database.sqlite at the
+destination by default). Keep the store to speed up later runs.
+
+To spread the work over several nodes run with --distributed and a redis
+store all nodes can reach, and start `pic_sort.py --worker --store <store>`
+on every node. The sources and the destination must be mounted at the same
+paths on all nodes.
 
 use -- to end optional arguments section
 '''
 
 parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter, description=description)
-parser.add_argument('-p', '--paths', type=str, help='search for pictures at the given path', required=True, nargs='+')
+parser.add_argument('-p', '--paths', type=str, help='search for pictures at the given path', nargs='+')
 parser.add_argument('-e', '--extensions', type=str, help='extensions which should be parsed', nargs='+', default=['jpg', 'jpeg', 'cr2', 'gpx'])
 parser.add_argument('-m', '--move', help='move all found pictures to destination path (the default is to copy them)', action='store_true')
+parser.add_argument('--placement', choices=placement_strategies, default='copy',
+        help='how files are placed into hashed/raw: auto uses a rename (--move) or a copy on write clone and hard link on the same device, a copy otherwise')
+parser.add_argument('--fan-out', dest='fan_out', type=lambda value: [ int(part) for part in value.split(',') if int(part) ],
+        help='sub directory levels of hashed/ as comma separated prefix lengths, e.g. 2,2 (the default for new destinations) or 0 for none')
+parser.add_argument('--hash-algorithm', dest='hash_algorithm', choices=hash_algorithms,
+        help='content id of new destinations (default: sha512), blake2b is faster and blake2b-tree hashes large files on all cores')
+parser.add_argument('--migrate-store', dest='migrate_store', help='move the stored files in place to the layout given by --fan-out', action='store_true')
+parser.add_argument('--partial-match', dest='partial_match', help='treat a file with the size and the first and last 64 KiB of a stored file as that file, '
+        'already stored files are recognised without reading them completely (files differing only in between are not told apart, not with --move)', action='store_true')
+parser.add_argument('-i', '--ingest', help='hash, copy/move and parse the exif data of each file in a single read', action='store_true')
 parser.add_argument('-t', '--threads', type=int, help='number of threads to use to process files', default=4)
-parser.add_argument('-q', '--queue-size', dest='queue_size', type=int, help='queue size to use to stack files to process', default=10)
-parser.add_argument('-s', '--redis-db-offset', dest='db_offset', type=int, help='first redis database to use', default=0)
+parser.add_argument('-q', '--queue-size', dest='queue_size', type=int, help='queue size to use to stack chunks of files to process '
+        '(with --distributed the chunks queued for the workers of all nodes)', default=10)
+parser.add_argument('-c', '--chunk-size', dest='chunk_size', type=int, help='number of files handed to a worker at once (default: adapted to the time per file)', default=0)
+parser.add_argument('--store', help='store to keep the state in: redis://<host>:<port>/<first database> or sqlite:///<path> (default: redis://localhost:6379/<redis-db-offset>)')
+parser.add_argument('-s', '--redis-db-offset', dest='db_offset', type=int, help='first of the 5 redis databases to use', default=0)
 parser.add_argument('-f', '--no-faces', dest='skip_faces', help='Skip face recognition', action='store_true')
-parser.add_argument('--max-diff', dest='max_diff', help='the maximum time difference allowed to treat a gpx location as valid for picture location', default=600)
-parser.add_argument('destination', help='destination path for the sorted picture tree')
+parser.add_argument('--face-size', dest='face_size', type=int, help='longer side in pixels images are decoded at for face detection, 0 for full size', default=1600)
+parser.add_argument('--near-duplicates', dest='near_duplicates', help='group visually similar pictures (resized, re-encoded copies, bursts) '
+        'by perceptual hashes into near_duplicates/<group>/ and report them in near_duplicates.json', action='store_true')
+parser.add_argument('--near-distance', dest='near_distance', type=int, help='maximum number of differing bits of the 64 bit hashes of near duplicates', default=6)
+parser.add_argument('--no-resume', dest='no_resume', help='start from scratch even if the last run was interrupted '
+        '(by default it is resumed, the files each stage already handled are skipped)', action='store_true')
+parser.add_argument('--full-rescan', dest='full_rescan', help='ignore the source manifest and all cached results and process every file again', action='store_true')
+parser.add_argument('--full-exif', dest='full_exif', help='also keep all exif tags of each file in the store (only the fields used for sorting are kept by default)', action='store_true')
+parser.add_argument('--migrate-meta', dest='migrate_meta', help='convert the meta data stored by older versions to the compact records once', action='store_true')
+parser.add_argument('--max-diff', dest='max_diff', type=int, help='the maximum time difference allowed to treat a gpx location as valid for picture location', default=600)
+parser.add_argument('--profile-stage', dest='profile_stage', help='run the given stage under cProfile and write its profile to profile_<stage>.prof at the destination, '
+        'stages are named like in run_report.json (e.g. hash_file, get_meta_data, detect_faces, resolve_locations, plan_links)')
+parser.add_argument('--distributed', help='queue the chunks of the worker stages in the redis store for the --worker processes of any number of nodes '
+        'instead of handling them with local workers', action='store_true')
+parser.add_argument('--worker', help='handle the chunks queued by a --distributed run in the store with --threads processes, '
+        'neither --paths nor the destination are given', action='store_true')
+parser.add_argument('--lease-timeout', dest='lease_timeout', type=int, help='seconds after which the chunk of a dead or hanging --worker '
+        'is taken over by another worker, must exceed the time of a chunk', default=queue_ops.lease_timeout)
+parser.add_argument('--idle-exit', dest='idle_exit', type=int, help='seconds without chunks after which a --worker exits (default: never)', default=0)
+parser.add_argument('destination', help='destination path for the sorted picture tree', nargs='?')
 
 exit_flag = False
 
 
 def main():
     args = parser.parse_args()
+    if args.worker:
+        return run_worker(args)
+    if not args.paths or not args.destination:
+        parser.error('the following arguments are required: -p/--paths, destination')
+    if args.distributed and not (args.store or 'redis://').startswith('redis://'):
+        parser.error('--distributed requires a redis store')
+    if args.placement == 'move-rename' and not args.move:
+        parser.error('--placement move-rename requires --move')
+    if args.partial_match and args.move:
+        parser.error('--partial-match can not be combined with --move, a source differing from a stored file only in between would be removed')
     print(args)
     print('\n')
     if args.move:
@@ -55,51 +107,156 @@ def main():
     print_bold('prepare destination')
     dest_dir = os.path.abspath(args.destination)
     prepare_dest(dest_dir)
+    report = RunReport(dest_dir, args.profile_stage)
+    try:
+        store = open_store(dest_dir, args.fan_out, migrate = args.migrate_store, algorithm = args.hash_algorithm)
+    except ValueError as e:
+        parser.error(e)
 
     print_bold('\nprepare database\n')
-    db = db_ops.init_db(os.path.join(dest_dir, 'database.bin'), db_offset=args.db_offset)
+    db = db_ops.init_db(args.store or 'redis://localhost:6379/{}'.format(args.db_offset), dest_dir, full_rescan=args.full_rescan,
+            resume=not args.no_resume)
+    if db.resumed:
+        print('Resuming the interrupted run\n')
+
+    scanner = Scanner(args.paths, [ '.' + extension for extension in args.extensions ], os.path.join(dest_dir, 'scan_cache.pickle'),
+            num_threads = args.threads, rescan = args.full_rescan)
+    if args.partial_match:
+        print_bold('index stored file sizes')
+        with report.stage('index_stored_sizes') as stage:
+            stage['items'] = index_stored_sizes(store, db.size_index)
+        print('Indexed {} stored files\n'.format(stage['items']))
+
+    if args.distributed:
+        pool = QueuePool(LeaseQueue(db.work_queue), size_queue = args.queue_size, chunk_size = args.chunk_size, report = report,
+                journal = db.journal, resume = db.resumed, quarantine = db.quarantine)
+    else:
+        pool = WorkerPool(num_threads = args.threads, size_queue = args.queue_size, chunk_size = args.chunk_size, report = report,
+                journal = db.journal, resume = db.resumed, quarantine = db.quarantine)
+
+    with pool:
+        if args.ingest:
+            print_bold('scan and ingest all files')
+            counters = pool.run(lookup_manifest, ingest_source, db = db.source_hash, iter_args = (scanner.scan(), store, db.source_manifest),
+                    handler_args = (store, move_file, args.placement, db.source_manifest, db.hash_meta, db.hash_exif if args.full_exif else None,
+                        db.size_index, args.partial_match, args.full_rescan, ))
+            print(format_counters(counters))
 
-    print_bold('count all files')
-    entries = 0
-    for filename in iter_files(args.paths, [ '.' + extension.lower() for extension in args.extensions ]):
-        entries += 1
-        stdout('{} files | {}'.format(entries, filename))
-    print('Need to proceed {} files[0K\r\n'.format(entries))
+            entries = db.source_hash.dbsize()
+        else:
+            print_bold('scan and hash all files')
+            counters = pool.run(lookup_manifest, hash_file, iter_args = (scanner.scan(), store, db.source_manifest), handler_args = ( store, db.source_manifest, db.size_index, args.partial_match, ), db = db.source_hash)
+            print(format_counters(counters))
 
-    print_bold('hash all files')
-    iter_threaded(iter_files, hash_file, num_threads = args.threads, size_queue = args.queue_size, handler_args = ( args.destination, ), db = db.source_hash,
-            iter_args = (args.paths, [ '.' + extension.lower() for extension in args.extensions ]), progress_max = entries)
+            entries = db.source_hash.dbsize()
 
-    entries = db.source_hash.dbsize()
+            print_bold('copy/move all files')
+            counters = pool.run(db_ops.iter_db, copy_move_file, progress_max = entries, db=db.hash_meta,
+                    iter_args=(db.source_hash,), handler_args = (store, move_file, args.placement, ))
+            print(format_counters(counters))
 
-    print_bold('copy/move all files')
-    iter_threaded(db_ops.iter_db, copy_move_file, progress_max = entries, db=db.hash_meta,
-            iter_args=(db.source_hash,), num_threads = args.threads, size_queue = args.queue_size, handler_args = (dest_dir, move_file, ))
+            print_bold('parse meta data')
+            counters = pool.run(db_ops.iter_db, get_meta_data, progress_max = entries, db=db.hash_meta,
+                    iter_args=(db.source_hash,), handler_args = (store, db.hash_meta, db.hash_exif if args.full_exif else None, args.full_rescan, ))
+            print(format_counters(counters))
+        scanner.save_cache()
+        print('Scanned {} files, {} directories listed, {} unchanged directories reused\n'.format(scanner.total, scanner.listed, scanner.reused))
 
-    print_bold('parse meta data')
-    iter_threaded(db_ops.iter_db, get_meta_data, progress_max = entries, db=db.hash_meta,
-            iter_args=(db.source_hash,), num_threads = args.threads, size_queue = args.queue_size, handler_args = (dest_dir, args.max_diff, ))
+        print_bold('parse gpx tracks')
+        gpx_index = os.path.join(dest_dir, 'gpx_index')
+        with report.stage('gpx_index') as stage:
+            rebuilt = location_ops.update_gpx_index(gpx_index, scanner.gpx_files, num_threads = args.threads)
+            location_ops.open_gpx_index(gpx_index)
+            stage['items'] = len(scanner.gpx_files)
+        print('{} gpx index with {} points from {} files\n'.format('Built' if rebuilt else 'Reused', len(location_ops.database['times']), len(scanner.gpx_files)))
 
-    print_bold('create date links')
-    iter_threaded(db_ops.iter_db, create_date_link, progress_max = entries, db=db.hash_datename,
-            iter_args=(db.source_hash,), num_threads = args.threads, size_queue = args.queue_size, handler_args = (dest_dir, db.hash_meta, ))
+        if args.migrate_meta:
+            print_bold('migrate meta data')
+            with report.stage('migrate_meta_data') as stage:
+                stage['items'] = migrate_meta_data(db.hash_meta, db.hash_exif)
+            print('Converted {} entries\n'.format(stage['items']))
 
-    print_bold('create by links')
-    iter_threaded(db_ops.iter_db, create_by_link, progress_max = entries,
-            iter_args=(db.source_hash,), num_threads = args.threads, size_queue = args.queue_size, handler_args = (dest_dir, db.hash_meta, db.hash_datename, ))
+        print_bold('resolve locations')
+        with report.stage('resolve_locations') as stage:
+            located, gpx_located, geocoded = resolve_locations(db.hash_meta, db.location_cache, args.max_diff)
+            stage['items'] = located
+        print('Resolved {} locations ({} by gpx tracks), {} places reverse geocoded\n'.format(located, gpx_located, geocoded))
 
-    print_bold('create location links')
-    iter_threaded(db_ops.iter_db, create_by_location, progress_max = entries,
-            iter_args=(db.source_hash,), num_threads = args.threads, size_queue = args.queue_size, handler_args = (dest_dir, db.hash_meta, db.hash_datename, ))
+        if not args.skip_faces:
+            import face_ops  # face_recognition is only needed with faces
+            face_params = face_ops.detector_params(args.face_size)
+            print_bold('detect faces')
+            pool.run(db_ops.iter_db, detect_faces, progress_max = entries, db=db.hash_face,
+                    iter_args=(db.source_hash,), handler_args = (store, db.hash_face, face_params, args.full_rescan, ))
 
-    if not args.skip_faces:
-        print_bold('detect faces')
-        iter_threaded(db_ops.iter_db, detect_faces, progress_max = entries, db=db.hash_face,
-                iter_args=(db.source_hash,), num_threads = args.threads, size_queue = args.queue_size, handler_args = (dest_dir, db.hash_face, db.hash_datename, ))
+        persons = {}
+        if not args.skip_faces:
+            print_bold('cluster faces')
+            face_index = os.path.join(dest_dir, 'face_index')
+            with report.stage('cluster_faces') as stage:
+                indexed, clusters = person_ops.update_face_index(face_index, db.hash_face, face_params, store)
+                persons = person_ops.load_person_clusters(face_index, face_params)
+                stage['items'] = indexed
+            print('{} new faces indexed, {} clusters\n'.format(indexed, clusters))
 
+        near_groups = {}
+        if args.near_duplicates:
+            print_bold('hash images')
+            pool.run(db_ops.iter_db, hash_image, progress_max = entries, db=db.hash_phash,
+                    iter_args=(db.source_hash,), handler_args = (store, db.hash_phash, args.full_rescan, ))
+
+            print_bold('group near duplicates')
+            with report.stage('group_near_duplicates') as stage:
+                groups = phash_ops.find_near_duplicates(db.hash_phash, args.near_distance, store)
+                near_groups, groups = phash_ops.name_groups(groups, store)
+                phash_ops.write_report(os.path.join(dest_dir, 'near_duplicates.json'), groups, db.hash_meta, db.hash_phash)
+                stage['items'] = len(near_groups)
+            print('{} groups of {} near duplicates\n'.format(len(groups), len(near_groups)))
+
+        print_bold('plan links')
+        link_stages = ['date', 'by', 'location']
+        # the trees of skipped stages are kept as they are
+        roots = list(link_ops.link_roots)
+        if not args.skip_faces:
+            link_stages.append('person')
+        else:
+            roots.remove('by_person')
+        if args.near_duplicates:
+            link_stages.append('near_duplicates')
+        else:
+            roots.remove('near_duplicates')
+        with report.stage('plan_links') as stage:
+            desired = plan_links(store, db.hash_meta, db.hash_datename, db.hash_face, link_stage_order(link_stages), persons, near_groups)
+            existing, dirs = link_ops.load_snapshot(dest_dir, rescan = args.full_rescan)
+            existing, kept = link_ops.split_links(existing, roots)
+            stage['items'] = len(desired)
+        print('{} links planned, {} links existing\n'.format(len(desired), len(existing)))
+
+        print_bold('update links')
+        with report.stage('apply_links') as stage:
+            created, deleted, retargeted, dirs = link_ops.apply_links(dest_dir, desired, existing, dirs)
+            link_ops.save_snapshot(dest_dir, {**kept, **desired}, dirs)
+            stage['items'] = created + deleted + retargeted
+        print('{} links created, {} deleted, {} retargeted\n'.format(created, deleted, retargeted))
+
+    quarantined = [ failure for _, failure in db_ops.iter_db(db.quarantine) ]
+    if quarantined:
+        print_bold('{} files quarantined'.format(len(quarantined)))
+        for failure in quarantined[:10]:
+            print('{} {}: {}'.format(failure['stage'], failure['entry'][0], failure['error']))
+        print('all failures are listed in the run report, they are retried by the next run\n')
+    print('Run report written to {}'.format(report.write(args = vars(args), files = entries, resumed = db.resumed, quarantine = quarantined)))
+    db_ops.finish_run(db)
     print('\n[1;32m   finished [0;32mprocessed {} files[0m\n[0m'.format(entries))
 
 
+def run_worker(args):
+    store_url = args.store or 'redis://localhost:6379/{}'.format(args.db_offset)
+    if not store_url.startswith('redis://'):
+        parser.error('--worker requires a redis store')
+    print_bold('handle the queued chunks of {} with {} workers'.format(store_url, args.threads))
+    queue_ops.run_workers(LeaseQueue(db_ops.open_db(store_url).work_queue), args.threads, args.lease_timeout, args.idle_exit)
+
 
 if __name__ == '__main__':
     main()
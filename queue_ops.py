@@ -0,0 +1,235 @@
+import os, time, uuid, pickle, socket, multiprocessing
+import db_ops
+from basic_ops import counters, counter_names
+from mt_ops import WorkerPool, handle_chunk, entry_attempts, poll_interval
+from report_ops import max_rss
+
+# seconds a leased task is invisible to other workers, after that it is stolen by the next worker asking for a task
+lease_timeout = 120
+# seconds an idle worker waits before it asks for a task again
+idle_interval = 0.2
+# seconds without results after which the coordinator hints that no workers are running
+waiting_hint = 10
+
+# the times are taken from the redis server, the clocks of the nodes do not matter
+lease_script = '''
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+while true do
+    local id = redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', string.format('%.6f', now), 'LIMIT', 0, 1)[1]
+    if not id then
+        id = redis.call('LPOP', KEYS[1])
+    end
+    if not id then
+        return false
+    end
+    local task = redis.call('HGET', KEYS[3], id)
+    if task then
+        redis.call('ZADD', KEYS[2], string.format('%.6f', now + tonumber(ARGV[1])), id)
+        return {id, task, redis.call('HINCRBY', KEYS[4], id, 1)}
+    end
+    redis.call('ZREM', KEYS[2], id)
+end
+'''
+
+ack_script = '''
+if redis.call('HGET', KEYS[3], ARGV[1]) ~= ARGV[2] then
+    return 0
+end
+redis.call('ZREM', KEYS[1], ARGV[1])
+redis.call('HDEL', KEYS[2], ARGV[1])
+redis.call('HDEL', KEYS[3], ARGV[1])
+redis.call('RPUSH', KEYS[4], ARGV[3])
+return 1
+'''
+
+
+class LeaseQueue:
+    '''
+    Durable task queue in a redis database (the work_queue namespace) shared by the coordinator and the workers of all nodes:
+        pending  - list of the ids of the queued tasks
+        tasks    - hash of id -> pickled task
+        leases   - sorted set of the ids of the leased tasks by the expiry of their lease
+        attempts - hash of id -> number of leases, identifies the current lease of a task
+        results  - list of the pickled results of the acked tasks
+    A leased task is invisible to the other workers until its lease expires (its worker died or hangs),
+    then the next lease() steals it. Only the current lease of a task can be acked, the result of a worker
+    whose lease was stolen is dropped. The ids start with a token of their run (see QueuePool),
+    so a worker still busy with a task of an earlier run cannot ack a task of the current one.
+    '''
+    def __init__(self, store):
+        if not isinstance(store, db_ops.RedisStore):
+            raise ValueError('the work queue requires a redis store')
+        self.store = store
+
+    def keys(self, *names):
+        return [ self.store.key(name) for name in names ]
+
+    def script(self, source, keys, args):
+        return self.store.connect().register_script(source)(keys=keys, args=args)
+
+    def clear(self):
+        self.store.flushdb()
+
+    def push(self, task_id, task):
+        pipeline = self.store.connect().pipeline()
+        pipeline.hset(self.store.key('tasks'), task_id, pickle.dumps(task, protocol=pickle.HIGHEST_PROTOCOL))
+        pipeline.rpush(self.store.key('pending'), task_id)
+        pipeline.execute()
+
+    def lease(self, timeout=lease_timeout):
+        '''
+        :return: id, task and attempt of the oldest expired lease or the next pending task, None if there is none
+        '''
+        leased = self.script(lease_script, self.keys('pending', 'leases', 'tasks', 'attempts'), [timeout])
+        if not leased:
+            return None
+        task_id, task, attempt = leased
+        return task_id.decode('UTF-8'), pickle.loads(task), int(attempt)
+
+    def ack(self, task_id, attempt, result):
+        '''
+        :return: whether the lease was still held and the result queued
+        '''
+        return bool(self.script(ack_script, self.keys('leases', 'tasks', 'attempts', 'results'),
+            [task_id, attempt, pickle.dumps(result, protocol=pickle.HIGHEST_PROTOCOL)]))
+
+    def result(self, timeout):
+        result = self.store.connect().blpop(self.keys('results'), timeout)
+        return pickle.loads(result[1]) if result else None
+
+    def results_waiting(self):
+        return self.store.connect().llen(self.store.key('results')) > 0
+
+    def counts(self):
+        '''
+        :return: number of pending and of leased tasks
+        '''
+        pipeline = self.store.connect().pipeline(transaction=False)
+        pipeline.llen(self.store.key('pending'))
+        pipeline.zcard(self.store.key('leases'))
+        return tuple(pipeline.execute())
+
+
+class QueuePool(WorkerPool):
+    '''
+    WorkerPool whose chunks are handled by the workers of any number of nodes (`pic_sort.py --worker`) instead of
+    local processes: the chunks are pushed to lease_queue and their results collected from it, at most size_queue
+    chunks are queued at once. Quarantine, journal and resume work like in the WorkerPool, a chunk whose lease
+    expired (its worker died) is split up by the next worker and requeued entry by entry. The tasks are queued
+    as (deaths, task) under the id <run>:<chunk id>, run is new for every coordinator.
+    '''
+    def __init__(self, lease_queue, size_queue=10, chunk_size=0, report=None, journal=None, resume=False, quarantine=None):
+        self.lease_queue = lease_queue
+        self.size_queue = size_queue
+        super().__init__(0, size_queue, chunk_size, report=report, journal=journal, resume=resume, quarantine=quarantine)
+
+    def start_workers(self, num_threads, size_queue):
+        # tasks of an earlier coordinator are stale, acks of their workers are dropped
+        self.lease_queue.clear()
+        self.run_token = uuid.uuid4().hex[:12]
+        self.last_result = time.perf_counter()
+        self.waiting = False
+
+    def close(self, terminate=False):
+        # the workers of other nodes keep running, the chunks of a failed run are not handled any more
+        if terminate:
+            self.lease_queue.clear()
+
+    def send(self, chunk_id, task):
+        # requeued entries sent by collect() while waiting here do not wait again
+        if not self.waiting:
+            self.waiting = True
+            while len(self.in_flight) > self.size_queue:
+                self.collect(self.progress_max)
+            self.waiting = False
+        if len(self.in_flight) == 1:  # the first chunk since the pool was idle
+            self.last_result = time.perf_counter()
+        self.lease_queue.push('{}:{}'.format(self.run_token, chunk_id), (self.in_flight[chunk_id][1], task))
+
+    def receive(self):
+        result = self.lease_queue.result(poll_interval)
+        if result is None:
+            return None
+        self.last_result = time.perf_counter()
+        chunk_id, timing = result[0], result[-1]
+        if timing.get('split'):
+            entries = self.in_flight.pop(chunk_id, (None, 0))[0]
+            if entries:
+                self.requeued += [ ([entry], timing['split']) for entry in entries ]
+            return None
+        return result
+
+    def results_waiting(self):
+        return self.lease_queue.results_waiting()
+
+    def check_workers(self):
+        # dead workers are noticed by their expired leases, the coordinator only tells if nobody takes the tasks
+        self.checked = time.perf_counter()
+        if self.in_flight and self.checked - self.last_result >= waiting_hint:
+            pending, leased = self.lease_queue.counts()
+            if pending and not leased:
+                self.log_output = 'waiting for workers, {} chunks queued (start pic_sort.py --worker)'.format(pending)
+                self.render(self.progress_max)
+
+
+def work(lease_queue, timeout=lease_timeout, idle_exit=0):
+    '''
+    Worker loop of `pic_sort.py --worker`: leases a task, handles its chunk and acks the result.
+    A chunk leased before (its worker died or hung) is split up by the coordinator, a single entry is quarantined
+    once its expired leases and the workers it killed before it was split (deaths) reach entry_attempts.
+    Returns after idle_exit seconds without tasks, never if 0.
+    '''
+    for name in counter_names:
+        counters[name] = 0
+    worker_name = '{}:{}'.format(socket.gethostname(), os.getpid())
+    last_handler = None
+    idle_since = time.perf_counter()
+    while True:
+        leased = lease_queue.lease(timeout)
+        if leased is None:
+            if idle_exit and time.perf_counter() - idle_since >= idle_exit:
+                return
+            time.sleep(idle_interval)
+            continue
+        task_id, (deaths, task), attempt = leased
+        chunk_id, entries = task[:2]
+        deaths += attempt - 1
+        wait = time.perf_counter() - idle_since if task[3] == last_handler else 0
+        last_handler = task[3]
+        timing = {'worker': worker_name, 'wait': wait, 'cpu': 0, 'max_rss': max_rss(), 'latencies': [], 'profile': None, 'failed': [], 'deferred': []}
+        if attempt > 1 and len(entries) > 1:
+            timing['split'] = deaths
+            result = (len(entries), 0, '', dict.fromkeys(counter_names, 0), timing)
+        elif deaths >= entry_attempts:
+            timing['failed'] = [ {'entry': entry, 'error': 'lease expired {} times'.format(deaths), 'traceback': '',
+                'attempts': deaths} for entry in entries ]
+            result = (len(entries), 0, '', dict.fromkeys(counter_names, 0), timing)
+        else:
+            result = handle_chunk(*task[1:], wait=wait)
+            result[-1]['worker'] = worker_name
+        lease_queue.ack(task_id, attempt, (chunk_id,) + result)
+        idle_since = time.perf_counter()
+
+
+def run_workers(lease_queue, num_threads, timeout=lease_timeout, idle_exit=0):
+    '''
+    Runs num_threads worker processes until all of them were idle for idle_exit seconds (forever if 0),
+    dead workers are respawned, their task is stolen by another worker once its lease expired.
+    '''
+    def spawn(i):
+        process = multiprocessing.Process(name = '{}'.format(i), target=work, args=(lease_queue, timeout, idle_exit))
+        process.start()
+        return process
+
+    processes = { i: spawn(i) for i in range(num_threads) }
+    while processes:
+        time.sleep(poll_interval)
+        for i, process in list(processes.items()):
+            if process.is_alive():
+                continue
+            if process.exitcode == 0:
+                del processes[i]
+                continue
+            print('worker {} died with exit code {}, respawning it'.format(process.pid, process.exitcode))
+            processes[i] = spawn(i)
@@ -0,0 +1,124 @@
+import os
+import json
+import time
+import marshal
+import cProfile
+import pstats
+import resource
+import numpy
+from datetime import datetime
+from basic_ops import counters, counter_names, atomic_write
+
+
+class RunReport:
+    '''
+    Metrics of all stages of a run, written as json to the destination (run_report.json) at the end of the run.
+    Stages run by the WorkerPool are added by the pool, stages of the main process are measured by stage().
+    max_rss of a stage is the peak resident size (KiB) of its processes up to the end of the stage.
+    The stage named profile_stage is run under cProfile, its profile is written to profile_<stage>.prof.
+    '''
+    def __init__(self, dest_dir, profile_stage=None):
+        self.dest_dir = dest_dir
+        self.profile_stage = profile_stage
+        self.started = datetime.now().isoformat(timespec='seconds')
+        self.start = time.perf_counter()
+        self.stages = []
+
+    def add(self, metrics):
+        self.stages.append(metrics)
+
+    def stage(self, name):
+        return MainStage(self, name)
+
+    def add_profile(self, name, stats):
+        '''
+        Writes the profile stats (as collected by cProfile.Profile.create_stats) like pstats.Stats.dump_stats
+        and prints the functions with the highest cumulative time.
+        '''
+        path = os.path.join(self.dest_dir, 'profile_{}.prof'.format(name))
+        with open(path, 'wb') as f:
+            marshal.dump(stats, f)
+        print('profile of {} written to {}'.format(name, path))
+        pstats.Stats(path).sort_stats('cumulative').print_stats(15)
+
+    def write(self, **info):
+        totals = dict.fromkeys(counter_names, 0)
+        for metrics in self.stages:
+            for name, value in metrics['counters'].items():
+                totals[name] += value
+        report = {'started': self.started, 'wall_time': time.perf_counter() - self.start, **info,
+                'totals': { name: value for name, value in totals.items() if value }, 'stages': self.stages}
+        path = os.path.join(self.dest_dir, 'run_report.json')
+        with atomic_write(path) as f:
+            json.dump(report, f, indent=1, default=str)
+        return path
+
+
+class MainStage:
+    '''
+    Measures a stage run in the main process: wall and cpu time and the counters of the main process.
+    Entering returns the metrics dict, the stage may add its number of items.
+    '''
+    def __init__(self, report, name):
+        self.report = report
+        self.metrics = {'stage': name}
+        self.profiler = cProfile.Profile() if name == report.profile_stage else None
+
+    def __enter__(self):
+        self.counters = dict(counters)
+        self.start = time.perf_counter()
+        self.cpu_start = time.process_time()
+        if self.profiler:
+            self.profiler.enable()
+        return self.metrics
+
+    def __exit__(self, *args):
+        if self.profiler:
+            self.profiler.disable()
+        self.metrics.update({'wall_time': time.perf_counter() - self.start, 'cpu_time': time.process_time() - self.cpu_start,
+                'max_rss': max_rss(), 'counters': counter_deltas(self.counters)})
+        if 'items' in self.metrics:
+            self.metrics['items_per_s'] = self.metrics['items'] / max(self.metrics['wall_time'], 1e-9)
+        self.report.add(self.metrics)
+        if self.profiler:
+            self.profiler.create_stats()
+            self.report.add_profile(self.metrics['stage'], self.profiler.stats)
+
+
+def max_rss():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def counter_deltas(before):
+    # changes of the counters of this process since the snapshot before
+    return { name: counters[name] - before[name] for name in counter_names if counters[name] != before[name] }
+
+
+def merge_profile_stats(merged, stats):
+    # sums up the stats of cProfile.Profile.create_stats of several chunks and workers
+    for function, stat in stats.items():
+        merged[function] = pstats.add_func_stats(merged[function], stat) if function in merged else stat
+    return merged
+
+
+def latency_percentiles(latencies):
+    if not len(latencies):
+        return None
+    p50, p95, p99 = numpy.percentile(latencies, [50, 95, 99])
+    return {'p50': p50, 'p95': p95, 'p99': p99, 'max': float(numpy.max(latencies))}
+
+
+def format_metrics(metrics):
+    '''
+    One line summary of the metrics of a WorkerPool stage.
+    '''
+    output = ['{} files in {:.2f} s ({:.1f} files/s, {:.1f} MiB/s)'.format(metrics['items'], metrics['wall_time'],
+            metrics['items_per_s'], metrics['bytes_per_s'] / 1048576)]
+    if metrics['latency']:
+        output.append('latency p50 {p50:.1f} ms p95 {p95:.1f} ms p99 {p99:.1f} ms'.format(
+            **{ name: value * 1000 for name, value in metrics['latency'].items() }))
+    work = sum( worker['work'] for worker in metrics['workers'] )
+    wait = sum( worker['wait'] for worker in metrics['workers'] )
+    if work + wait:
+        output.append('workers busy {:.0f}%'.format(100 * work / (work + wait)))
+    return ' | '.join(output)
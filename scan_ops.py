@@ -0,0 +1,92 @@
+import os
+import pickle
+from file_ops import file_signature
+from basic_ops import atomic_write
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+
+class Scanner:
+    '''
+    Lists all files with the given extensions below paths in a single pass.
+    Directories are listed with scandir by a pool of threads, the files are yielded as soon as their directory is listed,
+    together with their signature (see file_ops.file_signature) from the stat of the directory entry.
+    Each listing is cached with the mtime of its directory, unchanged directories are not listed again by the next run,
+    only their files are stat'ed again for files changed in place. The cache is dropped if the extensions change.
+    gpx files are not yielded but collected in gpx_files.
+    '''
+    def __init__(self, paths, extensions, cache_path=None, num_threads=8, rescan=False):
+        self.paths = [ os.path.abspath(path) for path in paths ]
+        self.extensions = set( extension.lower() for extension in extensions )
+        self.cache_path = cache_path
+        self.num_threads = num_threads
+        self.cache = {}
+        if cache_path and not rescan and os.path.exists(cache_path):
+            with open(cache_path, 'rb') as f:
+                cache = pickle.load(f)
+            if cache.get('extensions') == self.extensions:
+                self.cache = cache['listings']
+        self.listings = {}
+        self.gpx_files = []
+        self.total = 0
+        self.listed = 0
+        self.reused = 0
+
+    def list_dir(self, directory):
+        '''
+        :return: list of (filename, signature) and list of sub directories of directory
+        '''
+        try:
+            mtime = os.stat(directory).st_mtime_ns
+        except OSError:
+            return [], []
+        cached = self.cache.get(directory)
+        if cached and cached[0] == mtime:
+            files = []
+            for path, _ in cached[1]:
+                try:
+                    files.append((path, file_signature(path, os.stat(path))))
+                except OSError:  # vanished without changing the directory mtime (e.g. coarse timestamps)
+                    pass
+            self.reused += 1
+            self.listings[directory] = (mtime, files, cached[2])
+            return files, cached[2]
+
+        files = []
+        subdirs = []
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            subdirs.append(entry.path)
+                        elif os.path.splitext(entry.name)[1].lower() in self.extensions:
+                            files.append((entry.path, file_signature(entry.path, entry.stat())))
+                    except OSError:  # vanished or dangling symlink
+                        pass
+        except OSError:  # not a directory, unreadable or vanished, skipped like os.walk does
+            return [], []
+        self.listed += 1
+        self.listings[directory] = (mtime, files, subdirs)
+        return files, subdirs
+
+    def scan(self):
+        with ThreadPoolExecutor(self.num_threads) as executor:
+            pending = set( executor.submit(self.list_dir, path) for path in self.paths )
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    files, subdirs = future.result()
+                    pending.update( executor.submit(self.list_dir, subdir) for subdir in subdirs )
+                    for entry in files:
+                        if entry[0].lower().endswith('.gpx'):
+                            self.gpx_files.append(entry[0])
+                            continue
+                        self.total += 1
+                        yield entry
+
+    def save_cache(self):
+        # only the directories seen by this run are kept
+        if not self.cache_path:
+            return
+        with atomic_write(self.cache_path, 'wb') as f:
+            pickle.dump({'extensions': self.extensions, 'listings': self.listings}, f, protocol=pickle.HIGHEST_PROTOCOL)
@@ -0,0 +1,228 @@
+import io
+import os
+import json
+import shutil
+import struct
+import numpy
+from datetime import datetime, timedelta
+from PIL import Image, ImageFilter
+
+# bump when the generated files change, libraries of other versions are generated again
+library_version = 1
+
+cameras = [('Canon', 'Canon EOS 5D Mark III'), ('Canon', 'Canon EOS 80D'), ('NIKON CORPORATION', 'NIKON D750'),
+        ('Apple', 'iPhone 12'), ('samsung', 'SM-G991B'), ('SONY', 'ILCE-7M3')]
+authors = ['Alice Example', 'Bob Example', 'Carol Example', '']
+# trips with gpx tracks: latitude, longitude
+places = [(48.7758, 9.1829), (52.5200, 13.4050), (41.9028, 12.4964), (40.7128, -74.0060), (35.6762, 139.6503), (-33.8688, 151.2093)]
+
+default_fractions = {'no_exif': 0.05, 'duplicate': 0.05, 'raw': 0.02, 'gps': 0.4, 'gpx': 0.3, 'burst': 0.15}
+
+ASCII = 2
+LONG = 4
+RATIONAL = 5
+
+
+def ifd(entries, offset, next_ifd=0):
+    '''
+    Serializes a little endian tiff ifd at offset, values longer than 4 bytes follow the ifd.
+    :param entries: list of (tag, type, count, value bytes)
+    :return: the bytes of the ifd and its values
+    '''
+    data_offset = offset + 2 + 12 * len(entries) + 4
+    table = struct.pack('<H', len(entries))
+    data = b''
+    for tag, field_type, field_count, value in sorted(entries):
+        if len(value) <= 4:
+            table += struct.pack('<HHL', tag, field_type, field_count) + value.ljust(4, b'\x00')
+        else:
+            table += struct.pack('<HHLL', tag, field_type, field_count, data_offset + len(data))
+            data += value + b'\x00' * (len(value) % 2)
+    return table + struct.pack('<L', next_ifd) + data
+
+
+def ascii_entry(tag, value):
+    value = value.encode('ascii') + b'\x00'
+    return (tag, ASCII, len(value), value)
+
+
+def rational_entry(tag, values):
+    return (tag, RATIONAL, len(values), b''.join( struct.pack('<LL', int(round(value * 10000)), 10000) for value in values ))
+
+
+def degrees(value):
+    value = abs(value)
+    return [int(value), int(value * 60) % 60, (value * 3600) % 60]
+
+
+def tiff_exif(make, model, date, unique_id, author=None, location=None, thumbnail=None, preview=None):
+    '''
+    Builds a tiff structure with the exif tags read by pic_sort (IFD0, exif and gps ifd) and an optional
+    JPEG thumbnail in IFD1 or an embedded preview referenced by the strips of IFD0 like in a CR2.
+    :return: the tiff bytes, the preview (if any) is appended at the end
+    '''
+    date = date.strftime('%Y:%m:%d %H:%M:%S')
+    image_entries = [ ascii_entry(0x010f, make), ascii_entry(0x0110, model), ascii_entry(0x0132, date) ]
+    if author:
+        image_entries.append(ascii_entry(0x013b, author))
+    pointers = [0x8769] + ([0x8825] if location else []) + ([0x0111, 0x0117] if preview else [])
+    image_size = 2 + 12 * (len(image_entries) + len(pointers)) + 4 + sum( len(entry[3]) + len(entry[3]) % 2 for entry in image_entries if len(entry[3]) > 4 )
+
+    exif_offset = 8 + image_size
+    exif_ifd = ifd([ ascii_entry(0x9003, date), ascii_entry(0x9004, date), ascii_entry(0xa420, '{:032x}'.format(unique_id)) ], exif_offset)
+    gps_offset = exif_offset + len(exif_ifd)
+    gps_ifd = b''
+    if location:
+        gps_ifd = ifd([ ascii_entry(0x0001, 'N' if location[0] >= 0 else 'S'), rational_entry(0x0002, degrees(location[0])),
+            ascii_entry(0x0003, 'E' if location[1] >= 0 else 'W'), rational_entry(0x0004, degrees(location[1])) ], gps_offset)
+    thumbnail_offset = gps_offset + len(gps_ifd)
+    thumbnail_ifd = b''
+    if thumbnail:
+        thumbnail_ifd = ifd([ (0x0201, LONG, 1, struct.pack('<L', thumbnail_offset + 2 + 12 * 2 + 4)),
+            (0x0202, LONG, 1, struct.pack('<L', len(thumbnail))) ], thumbnail_offset) + thumbnail
+    preview_offset = thumbnail_offset + len(thumbnail_ifd)
+
+    image_entries.append((0x8769, LONG, 1, struct.pack('<L', exif_offset)))
+    if location:
+        image_entries.append((0x8825, LONG, 1, struct.pack('<L', gps_offset)))
+    if preview:
+        image_entries.append((0x0111, LONG, 1, struct.pack('<L', preview_offset)))
+        image_entries.append((0x0117, LONG, 1, struct.pack('<L', len(preview))))
+    image_ifd = ifd(image_entries, 8, thumbnail_offset if thumbnail else 0)
+    return b'II*\x00' + struct.pack('<L', 8) + image_ifd + exif_ifd + gps_ifd + thumbnail_ifd + (preview or b'')
+
+
+def jpeg_with_exif(jpeg, tiff):
+    app1 = b'Exif\x00\x00' + tiff
+    return jpeg[:2] + b'\xff\xe1' + struct.pack('>H', len(app1) + 2) + app1 + jpeg[2:]
+
+
+def jpeg_with_comment(jpeg, comment):
+    comment = comment.encode('ascii')
+    return jpeg[:2] + b'\xff\xfe' + struct.pack('>H', len(comment) + 2) + comment + jpeg[2:]
+
+
+def base_images(rng, count, size):
+    '''
+    Smooth random pictures (upscaled and blurred noise) encoded once as JPEG and as 160 pixel thumbnail,
+    the generated files share them and differ by their exif data.
+    '''
+    images = []
+    for _ in range(count):
+        noise = rng.integers(0, 256, (12, 16, 3), dtype=numpy.uint8)
+        image = Image.fromarray(noise).resize(size, Image.BICUBIC).filter(ImageFilter.GaussianBlur(size[0] / 100))
+        jpeg = io.BytesIO()
+        image.save(jpeg, 'JPEG', quality=85)
+        thumbnail = io.BytesIO()
+        image.resize((160, 160 * size[1] // size[0])).save(thumbnail, 'JPEG', quality=75)
+        images.append((jpeg.getvalue(), thumbnail.getvalue()))
+    return images
+
+
+def gpx_track(times, latitudes, longitudes):
+    lines = ['<?xml version="1.0" encoding="UTF-8"?>', '<gpx version="1.1" creator="synth_ops">', '<trk><trkseg>']
+    times = numpy.datetime_as_string(numpy.asarray(times, dtype=numpy.int64).astype('datetime64[s]'))
+    for time, latitude, longitude in zip(times, latitudes, longitudes):
+        lines.append('<trkpt lat="{:.6f}" lon="{:.6f}"><time>{}Z</time></trkpt>'.format(latitude, longitude, time))
+    lines += ['</trkseg></trk>', '</gpx>']
+    return '\n'.join(lines)
+
+
+def library_params(files, seed, image_size, raw_size, fractions):
+    return {'version': library_version, 'files': files, 'seed': seed, 'image_size': list(image_size), 'raw_size': raw_size, 'fractions': fractions}
+
+
+def generate_library(directory, files, seed=0, image_size=(320, 240), raw_size=8, fractions=default_fractions, files_per_dir=500):
+    '''
+    Generates a reproducible synthetic photo library of files pictures below directory:
+    JPEGs with camera, author, date (including same second bursts) and partly gps exif data, JPEGs without exif data,
+    byte identical duplicates in other directories, CR2 like raw files of raw_size MiB with an embedded preview
+    and gpx tracks covering the trips of the photos without gps data.
+    The library is only generated again if it was generated with other parameters.
+    :return: the parameters recorded in library.json
+    '''
+    params = library_params(files, seed, image_size, raw_size, fractions)
+    params_path = os.path.join(directory, 'library.json')
+    if os.path.exists(params_path):
+        with open(params_path) as f:
+            if json.load(f) == params:
+                return params
+        shutil.rmtree(directory)
+    elif os.path.isdir(directory) and os.listdir(directory):
+        raise ValueError('{} is not empty and no generated library'.format(directory))
+    os.makedirs(directory, exist_ok=True)
+
+    rng = numpy.random.default_rng(seed)
+    images = base_images(rng, 64, tuple(image_size))
+    date = datetime(2015, 1, 1, 8, 0, 0)
+    trip = None
+    tracks = []
+    written = []
+    burst_left = 0
+    for i in range(files):
+        directory_index = i // files_per_dir
+        file_dir = os.path.join(directory, '{:04}'.format(2015 + directory_index // 50), 'import_{:05}'.format(directory_index))
+        if i % files_per_dir == 0:
+            os.makedirs(file_dir, exist_ok=True)
+
+        kind = rng.random()
+        if written and kind < fractions['duplicate']:
+            source = written[rng.integers(len(written))]
+            with open(source, 'rb') as f:
+                data = f.read()
+            with open(os.path.join(file_dir, 'copy_{:07}{}'.format(i, os.path.splitext(source)[1])), 'wb') as f:
+                f.write(data)
+            continue
+
+        # a burst shares the second and the picture of the previous photo
+        if burst_left:
+            burst_left -= 1
+        else:
+            date += timedelta(seconds=int(rng.integers(30, 4 * 3600)))
+            if date.hour >= 22:
+                date = date.replace(hour=8) + timedelta(days=int(rng.integers(1, 5)))
+                trip = None
+            image = images[rng.integers(len(images))]
+            if rng.random() < fractions['burst']:
+                burst_left = int(rng.integers(2, 6))
+        if trip is None and rng.random() < fractions['gpx']:
+            place = places[rng.integers(len(places))]
+            trip = {'place': place, 'start': date.timestamp(), 'end': date.timestamp()}
+            tracks.append(trip)
+        if trip is not None:
+            trip['end'] = date.timestamp()
+
+        make, model = cameras[rng.integers(len(cameras))]
+        author = authors[rng.integers(len(authors))]
+        location = None
+        if trip is None and rng.random() < fractions['gps']:
+            place = places[rng.integers(len(places))]
+            location = (place[0] + rng.normal(0, 0.05), place[1] + rng.normal(0, 0.05))
+
+        jpeg, thumbnail = image
+        if kind < fractions['duplicate'] + fractions['no_exif']:
+            path = os.path.join(file_dir, 'image_{:07}.jpg'.format(i))
+            data = jpeg_with_comment(jpeg, 'synthetic {}'.format(i))
+        elif kind < fractions['duplicate'] + fractions['no_exif'] + fractions['raw']:
+            path = os.path.join(file_dir, 'IMG_{:07}.CR2'.format(i))
+            data = tiff_exif(make, model, date, i, author, location, preview=jpeg)
+            data += rng.bytes(max(0, raw_size * 1048576 - len(data)))
+        else:
+            path = os.path.join(file_dir, 'IMG_{:07}.JPG'.format(i))
+            data = jpeg_with_exif(jpeg, tiff_exif(make, model, date, i, author, location, thumbnail=thumbnail))
+        with open(path, 'wb') as f:
+            f.write(data)
+        written.append(path)
+
+    # tracks with a point every 30 seconds around the place of the trip
+    gpx_dir = os.path.join(directory, 'gpx')
+    os.makedirs(gpx_dir, exist_ok=True)
+    for i, trip in enumerate(tracks):
+        times = numpy.arange(trip['start'] - 600, trip['end'] + 600, 30)
+        walk = numpy.cumsum(rng.normal(0, 0.0002, (len(times), 2)), axis=0)
+        with open(os.path.join(gpx_dir, 'track_{:05}.gpx'.format(i)), 'w') as f:
+            f.write(gpx_track(times, trip['place'][0] + walk[:, 0], trip['place'][1] + walk[:, 1]))
+
+    with open(params_path, 'w') as f:
+        json.dump(params, f)
+    return params